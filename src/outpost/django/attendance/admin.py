@@ -48,3 +48,11 @@ class StatisticsEntryInline(admin.TabularInline):
 @admin.register(models.Statistics)
 class StatisticsAdmin(admin.ModelAdmin):
     inlines = [StatisticsEntryInline]
+
+
+@admin.register(models.CampusOnlineOutbox)
+class CampusOnlineOutboxAdmin(admin.ModelAdmin):
+    list_display = ("table", "buchung_nr", "origin", "created", "flushed", "attempts")
+    list_filter = ("table", "origin")
+    readonly_fields = ("table", "origin", "buchung_nr", "data", "created", "flushed")
+    date_hierarchy = "created"
@@ -1,7 +1,12 @@
+import hashlib
 import logging
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.http import parse_etags
 from django_filters.rest_framework import DjangoFilterBackend
 from guardian.shortcuts import get_objects_for_user
 from outpost.django.api.permissions import ExtendedDjangoModelPermissions
@@ -10,15 +15,82 @@ from rest_flex_fields.views import FlexFieldsMixin
 from rest_framework import exceptions, permissions, viewsets
 from rest_framework.decorators import action
 from rest_framework.filters import OrderingFilter
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework_guardian.filters import ObjectPermissionsFilter
 
-from . import filters, models, serializers
-from .permissions import ActiveCampusOnlineHoldingPermission
+from . import events, filters, models, serializers
+from .cache import changes
+from .conf import settings
+from .permissions import ActiveCampusOnlineHoldingPermission, lecturer
+from .renderers import EventStreamRenderer
 
 logger = logging.getLogger(__name__)
 
 
+def event_stream(*topics):
+    response = StreamingHttpResponse(
+        events.stream(*topics), content_type=EventStreamRenderer.media_type
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+class ConditionalMixin(object):
+    """
+    Answer `If-None-Match` with `304` before the response is built.
+
+    ETags are derived from the change counters of the single object on
+    detail routes or of `list_scopes` on list routes, together with the
+    user, the full path and the accepted media type. They also roll over
+    every `ATTENDANCE_CONDITIONAL_TIMEOUT` to pick up changes that are not
+    counted, like updates to CAMPUSonline data.
+    """
+
+    change_scope = None
+
+    def list_scopes(self, request):
+        """
+        Counters covering the objects of a list route, defaults to the counter
+        of `change_scope` which is bumped by every change to any object.
+        """
+        return [self.change_scope]
+
+    def etag(self, request):
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if lookup is not None:
+            scopes = [f"{self.change_scope}:{lookup}"]
+        else:
+            scopes = self.list_scopes(request)
+        timeout = settings.ATTENDANCE_CONDITIONAL_TIMEOUT.total_seconds()
+        value = (
+            list(zip(scopes, changes.get(*scopes))),
+            int(timezone.now().timestamp() // timeout),
+            request.user.pk,
+            request.get_full_path(),
+            request.accepted_media_type,
+        )
+        return '"{}"'.format(hashlib.sha1(repr(value).encode()).hexdigest())
+
+    def conditional(self, handler, request, *args, **kwargs):
+        etag = self.etag(request)
+        matches = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+        if etag in matches:
+            response = Response(status=304)
+        else:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response["ETag"] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+
 class TerminalViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     queryset = models.Terminal.objects.filter(enabled=True, online=True)
     serializer_class = serializers.TerminalSerializer
@@ -26,9 +98,12 @@ class TerminalViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     permit_list_expands = ("rooms",)
 
 
-class CampusOnlineHoldingViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
+class CampusOnlineHoldingViewSet(
+    ConditionalMixin, FlexFieldsMixin, viewsets.ModelViewSet
+):
     queryset = models.CampusOnlineHolding.objects.all()
     serializer_class = serializers.CampusOnlineHoldingSerializer
+    change_scope = "holding"
     filter_backends = (DjangoFilterBackend, OrderingFilter)
     filter_class = filters.CampusOnlineHoldingFilter
     ordering_fields = ("initiated",)
@@ -48,19 +123,45 @@ class CampusOnlineHoldingViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     ]
 
     def get_queryset(self):
-        username = self.request.user.username
-        return self.queryset.filter(
-            lecturer__username=username, state__in=("pending", "running")
-        )
+        person = lecturer(self.request)[0]
+        if person is None:
+            return self.queryset.none()
+        return self.queryset.filter(lecturer=person, state__in=("pending", "running"))
+
+    def list_scopes(self, request):
+        # Pending holdings are covered by the lecturer's counter, changes to
+        # entries by the counters of the running holdings.
+        person, holdings = lecturer(request)
+        return [f"lecturer:{person}"] + [f"holding:{pk}" for pk in sorted(holdings)]
+
+    def get_serializer(self, *args, **kwargs):
+        if args and kwargs.get("many", False):
+            holdings, *args = args
+            args = [models.CampusOnlineHolding.prefetch_accredited(holdings)] + args
+        return super().get_serializer(*args, **kwargs)
 
     @action(methods=["start", "end", "cancel"], detail=True)
     def transition(self, request, pk=None):
         holding = self.get_object()
-        getattr(holding, request.method.lower())()
-        holding.save()
+        # Outbox rows and entry changes must commit together with the holding.
+        with transaction.atomic():
+            getattr(holding, request.method.lower())()
+            holding.save()
         data = self.serializer_class(holding).data
         return Response(data)
 
+    @action(
+        methods=["get"],
+        detail=True,
+        renderer_classes=(EventStreamRenderer, JSONRenderer),
+    )
+    def stream(self, request, pk=None):
+        """
+        Server-sent events for changes to entries of this holding.
+        """
+        holding = self.get_object()
+        return event_stream(f"holding:{holding.pk}")
+
 
 class CampusOnlineEntryViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     queryset = models.CampusOnlineEntry.objects.all()
@@ -76,10 +177,8 @@ class CampusOnlineEntryViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     http_method_names = viewsets.ModelViewSet.http_method_names + ["discard"]
 
     def get_queryset(self):
-        username = self.request.user.username
-        return self.queryset.filter(
-            holding__lecturer__username=username, holding__state="running"
-        )
+        holdings = lecturer(self.request)[1]
+        return self.queryset.filter(holding__in=list(holdings))
 
     @action(methods=["discard"], detail=True)
     def transition(self, request, pk=None):
@@ -104,10 +203,8 @@ class ManualCampusOnlineEntryViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     http_method_names = viewsets.ModelViewSet.http_method_names + ["discard", "leave"]
 
     def get_queryset(self):
-        username = self.request.user.username
-        return self.queryset.filter(
-            holding__lecturer__username=username, holding__state="running"
-        )
+        holdings = lecturer(self.request)[1]
+        return self.queryset.filter(holding__in=list(holdings))
 
     @action(methods=["discard", "leave"], detail=True)
     def transition(self, request, pk=None):
@@ -118,16 +215,42 @@ class ManualCampusOnlineEntryViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
         return Response(data)
 
 
-class RoomStateViewSet(FlexFieldsMixin, viewsets.ReadOnlyModelViewSet):
+class RoomStateViewSet(
+    ConditionalMixin, FlexFieldsMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = co.Room.objects.exclude(terminals=None)
     serializer_class = serializers.RoomStateSerializer
+    change_scope = "room"
     permission_classes = (permissions.IsAuthenticated,)
     permit_list_expands = ("students",)
 
+    def get_queryset(self):
+        allocations = serializers.RoomStateSerializer.allocations(timezone.now())
+        return self.queryset.annotate(
+            hybrid=Exists(allocations.filter(room=OuterRef("pk")))
+        )
+
+    def list_scopes(self, request):
+        rooms = self.queryset.order_by("pk").values_list("pk", flat=True).distinct()
+        return [f"room:{pk}" for pk in rooms]
+
+    @action(
+        methods=["get"],
+        detail=True,
+        renderer_classes=(EventStreamRenderer, JSONRenderer),
+    )
+    def stream(self, request, pk=None):
+        """
+        Server-sent events for changes to entries in this room.
+        """
+        room = self.get_object()
+        return event_stream(f"room:{room.pk}")
+
 
-class StatisticsViewSet(viewsets.ModelViewSet):
+class StatisticsViewSet(ConditionalMixin, viewsets.ModelViewSet):
     queryset = models.Statistics.objects.all()
     serializer_class = serializers.StatisticsSerializer
+    change_scope = "statistics"
     permission_classes = (ExtendedDjangoModelPermissions,)
     filter_backends = (ObjectPermissionsFilter,)
 
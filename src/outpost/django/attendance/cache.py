@@ -0,0 +1,468 @@
+import logging
+from collections import OrderedDict
+from threading import RLock
+from time import perf_counter, sleep
+
+from django.core.cache import caches
+from django.utils import timezone
+
+from . import metrics
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TerminalCache(object):
+    """
+    Per-process cache of terminal snapshots.
+
+    A snapshot is a `Terminal` instance with its rooms and statistics
+    prefetched, so plugins can walk `terminal.rooms.all()` and
+    `terminal.statistics_set.all()` without issuing queries. Entries are
+    dropped by the model signals in `models` whenever a terminal, its rooms or
+    its statistics change and expire after
+    `ATTENDANCE_TERMINAL_CACHE_TIMEOUT` to pick up changes made by other
+    processes.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.snapshots = dict()
+
+    def load(self, pk):
+        from .models import Terminal
+
+        return Terminal.objects.prefetch_related("rooms", "statistics_set").get(
+            pk=pk
+        )
+
+    def get(self, pk):
+        pk = int(pk)
+        now = timezone.now()
+        with self.lock:
+            snapshot = self.snapshots.get(pk)
+        if snapshot:
+            terminal, expires = snapshot
+            if expires > now:
+                return terminal
+        terminal = self.load(pk)
+        logger.debug(f"Caching snapshot of terminal {terminal}")
+        with self.lock:
+            self.snapshots[pk] = (
+                terminal,
+                now + settings.ATTENDANCE_TERMINAL_CACHE_TIMEOUT,
+            )
+        return terminal
+
+    def invalidate(self, *pks):
+        with self.lock:
+            if not pks:
+                self.snapshots.clear()
+                return
+            for pk in pks:
+                self.snapshots.pop(pk, None)
+
+
+class StudentCache(object):
+    """
+    Bounded per-process LRU cache resolving card IDs to students.
+
+    Known students are kept for `ATTENDANCE_STUDENT_CACHE_TIMEOUT`, unknown
+    card IDs for `ATTENDANCE_STUDENT_CACHE_NEGATIVE_TIMEOUT`. The least
+    recently used card ID is evicted once `ATTENDANCE_STUDENT_CACHE_SIZE` is
+    reached.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.students = OrderedDict()
+
+    def load(self, cardid):
+        from outpost.django.campusonline.models import Student
+
+        try:
+            return Student.objects.get(cardid=cardid)
+        except Student.DoesNotExist:
+            return None
+
+    def get(self, cardid):
+        from outpost.django.campusonline.models import Student
+
+        now = timezone.now()
+        with self.lock:
+            cached = self.students.get(cardid)
+            if cached and cached[1] > now:
+                self.students.move_to_end(cardid)
+                student = cached[0]
+            else:
+                cached = None
+        if cached:
+            metrics.student_cache.labels("hit" if student else "negative").inc()
+        else:
+            metrics.student_cache.labels("miss").inc()
+            student = self.load(cardid)
+            if student:
+                expires = now + settings.ATTENDANCE_STUDENT_CACHE_TIMEOUT
+            else:
+                expires = now + settings.ATTENDANCE_STUDENT_CACHE_NEGATIVE_TIMEOUT
+            with self.lock:
+                self.students[cardid] = (student, expires)
+                self.students.move_to_end(cardid)
+                while len(self.students) > settings.ATTENDANCE_STUDENT_CACHE_SIZE:
+                    self.students.popitem(last=False)
+        if not student:
+            raise Student.DoesNotExist(f"No student with card ID {cardid}")
+        return student
+
+    def invalidate(self, *cardids):
+        with self.lock:
+            if not cardids:
+                self.students.clear()
+                return
+            for cardid in cardids:
+                self.students.pop(cardid, None)
+
+
+class Debounce(object):
+    """
+    Shared record of recent clock responses per terminal and card ID.
+
+    A clock request claims its key with `pending` before it is processed and
+    replaces it with the response once it is done. Responses are kept in the
+    cache named by `ATTENDANCE_CACHE` for `ATTENDANCE_CLOCK_DEBOUNCE`, so a
+    repeated swipe on any process can be answered without touching the
+    database. A swipe arriving while the first one is still processed waits
+    up to `ATTENDANCE_CLOCK_DEBOUNCE_WAIT` for its response. A window of
+    `None` disables debouncing.
+    """
+
+    pending = "pending"
+
+    def key(self, terminal, cardid):
+        return f"{__name__}.Debounce:{int(terminal)}:{cardid}"
+
+    def claim(self, terminal, cardid):
+        """
+        Claim a terminal and card ID for a new clock.
+
+        Returns `None` if the claim succeeded or the cache could not be used
+        within `ATTENDANCE_CLOCK_DEBOUNCE_WAIT`, otherwise the recorded
+        response or `pending` if it did not arrive in time.
+        """
+        if not settings.ATTENDANCE_CLOCK_DEBOUNCE:
+            return None
+        cache = caches[settings.ATTENDANCE_CACHE]
+        key = self.key(terminal, cardid)
+        timeout = settings.ATTENDANCE_CLOCK_DEBOUNCE.total_seconds()
+        wait = settings.ATTENDANCE_CLOCK_DEBOUNCE_WAIT.total_seconds()
+        deadline = perf_counter() + wait
+        while True:
+            if cache.add(key, self.pending, timeout):
+                return None
+            data = cache.get(key)
+            if data is not None and data != self.pending:
+                return data
+            if perf_counter() > deadline:
+                # Either still pending or the cache keeps failing to store or
+                # return the key, in which case the swipe is processed anyway.
+                return self.pending if data is not None else None
+            sleep(0.05)
+
+    def set(self, terminal, cardid, data):
+        if not settings.ATTENDANCE_CLOCK_DEBOUNCE:
+            return
+        cache = caches[settings.ATTENDANCE_CACHE]
+        cache.set(
+            self.key(terminal, cardid),
+            data,
+            settings.ATTENDANCE_CLOCK_DEBOUNCE.total_seconds(),
+        )
+
+    def release(self, terminal, cardid):
+        if not settings.ATTENDANCE_CLOCK_DEBOUNCE:
+            return
+        cache = caches[settings.ATTENDANCE_CACHE]
+        cache.delete(self.key(terminal, cardid))
+
+
+class PreflightCache(object):
+    """
+    Shared cache of preflight responses per terminal and student.
+
+    Each student has a version counter that is part of the cache key and is
+    bumped whenever the student clocks or one of the student's CO entries
+    changes, so a cached response never outlives a change to the student's
+    open entry.
+    """
+
+    def version(self, student):
+        cache = caches[settings.ATTENDANCE_CACHE]
+        return cache.get(f"{__name__}.PreflightCache:{student}", 0)
+
+    def key(self, terminal, student):
+        version = self.version(student)
+        return f"{__name__}.PreflightCache:{int(terminal)}:{student}:{version}"
+
+    def get(self, terminal, student):
+        if not settings.ATTENDANCE_PREFLIGHT_CACHE_TIMEOUT:
+            return None
+        cache = caches[settings.ATTENDANCE_CACHE]
+        return cache.get(self.key(terminal, student))
+
+    def set(self, terminal, student, data):
+        if not settings.ATTENDANCE_PREFLIGHT_CACHE_TIMEOUT:
+            return
+        cache = caches[settings.ATTENDANCE_CACHE]
+        cache.set(
+            self.key(terminal, student),
+            data,
+            settings.ATTENDANCE_PREFLIGHT_CACHE_TIMEOUT.total_seconds(),
+        )
+
+    def invalidate(self, student):
+        cache = caches[settings.ATTENDANCE_CACHE]
+        key = f"{__name__}.PreflightCache:{student}"
+        try:
+            cache.incr(key)
+        except ValueError:
+            if not cache.add(key, 1, None):
+                cache.incr(key)
+
+
+class RoomStateCache(object):
+    """
+    Shared snapshot of today's card and manual entries per room.
+
+    Snapshots are built from the database on the first read and are then
+    kept up to date by the model signals in `models`. The version of a
+    snapshot is the `room:<pk>` counter in `changes`, which is bumped before
+    each change is applied. Entries are kept serialized together with their
+    student ID so onsite status can be added when the snapshot is read.
+    Writers to the same room are serialized by a short lock, a change is
+    only dropped together with the snapshot if the lock cannot be taken
+    within `ATTENDANCE_ROOMSTATE_LOCK_WAIT`.
+    """
+
+    kinds = ("cards", "manuals")
+
+    def key(self, room, *suffix):
+        return ":".join([f"{__name__}.RoomStateCache", str(room)] + list(suffix))
+
+    def today(self):
+        return timezone.localdate()
+
+    @property
+    def cache(self):
+        return caches[settings.ATTENDANCE_CACHE]
+
+    def serialize(self, kind, obj):
+        from .serializers import (
+            CampusOnlineEntrySerializer,
+            ManualCampusOnlineEntrySerializer,
+        )
+
+        # Onsite status depends on room allocations and is added on reads.
+        if kind == "cards":
+            data = CampusOnlineEntrySerializer(obj, expand=["student"]).data
+            return (obj.incoming.student_id, dict(data))
+        data = ManualCampusOnlineEntrySerializer(obj, expand=["student"]).data
+        return (obj.student_id, dict(data))
+
+    def querysets(self, day):
+        from .models import CampusOnlineEntry, ManualCampusOnlineEntry
+
+        return {
+            "cards": CampusOnlineEntry.objects.filter(
+                state__in=("created", "assigned"), incoming__created__date=day
+            ).select_related("incoming__student"),
+            "manuals": ManualCampusOnlineEntry.objects.filter(
+                state="assigned", assigned__date=day
+            ).select_related("student"),
+        }
+
+    def current(self, kind, obj, day):
+        if kind == "cards":
+            if obj.state not in ("created", "assigned"):
+                return False
+            timestamp = obj.incoming.created
+        else:
+            if obj.state != "assigned" or not obj.assigned:
+                return False
+            timestamp = obj.assigned
+        return timezone.localtime(timestamp).date() == day
+
+    def versions(self, rooms):
+        return dict(zip(rooms, changes.get(*[f"room:{room}" for room in rooms])))
+
+    def build(self, rooms, day):
+        versions = self.versions(rooms)
+        snapshots = {
+            room: {"version": versions[room], "cards": dict(), "manuals": dict()}
+            for room in rooms
+        }
+        for kind, qs in self.querysets(day).items():
+            for obj in qs.filter(room__in=rooms).distinct():
+                snapshots[obj.room_id][kind][obj.pk] = self.serialize(kind, obj)
+        # Only keep snapshots if no change happened while building them.
+        timeout = settings.ATTENDANCE_ROOMSTATE_TIMEOUT.total_seconds()
+        for room, version in self.versions(rooms).items():
+            if version == versions[room]:
+                key = self.key(room, day.isoformat())
+                self.cache.add(key, snapshots[room], timeout)
+        return snapshots
+
+    def get_many(self, rooms):
+        day = self.today()
+        rooms = list(rooms)
+        keys = {self.key(room, day.isoformat()): room for room in rooms}
+        snapshots = {
+            keys[key]: snapshot for key, snapshot in self.cache.get_many(keys).items()
+        }
+        missing = [room for room in rooms if room not in snapshots]
+        if missing:
+            snapshots.update(self.build(missing, day))
+        return snapshots
+
+    def lock(self, room):
+        lock = self.key(room, "lock")
+        wait = settings.ATTENDANCE_ROOMSTATE_LOCK_WAIT.total_seconds()
+        deadline = perf_counter() + wait
+        while not self.cache.add(lock, True, 5):
+            if perf_counter() > deadline:
+                return None
+            sleep(0.01)
+        return lock
+
+    def update(self, kind, room, entries, version):
+        """
+        Apply changes to the snapshot of a room.
+
+        `entries` maps primary keys to their entry or to `None` if the entry
+        no longer exists. `version` is the room's counter after it was bumped
+        for these changes.
+        """
+        if room is None:
+            return
+        day = self.today()
+        key = self.key(room, day.isoformat())
+        lock = self.lock(room)
+        if not lock:
+            logger.warn(f"Dropping room state of {room}, lock not available")
+            self.cache.delete(key)
+            return
+        try:
+            snapshot = self.cache.get(key)
+            if snapshot is None:
+                return
+            for pk, obj in entries.items():
+                if obj is not None and self.current(kind, obj, day):
+                    snapshot[kind][pk] = self.serialize(kind, obj)
+                else:
+                    snapshot[kind].pop(pk, None)
+            snapshot["version"] = max(snapshot["version"], version)
+            self.cache.set(
+                key, snapshot, settings.ATTENDANCE_ROOMSTATE_TIMEOUT.total_seconds()
+            )
+        finally:
+            self.cache.delete(lock)
+
+
+class ChangeCounters(object):
+    """
+    Shared counters bumped whenever data behind an API resource changes.
+
+    Scopes are either a resource type like `holding` or a single resource
+    like `holding:1`. Bumping a single resource also bumps its type, so list
+    and detail endpoints can both be validated with one lookup.
+    """
+
+    def key(self, scope):
+        return f"{__name__}.ChangeCounters:{scope}"
+
+    def get(self, *scopes):
+        cache = caches[settings.ATTENDANCE_CACHE]
+        versions = cache.get_many([self.key(s) for s in scopes])
+        return tuple(versions.get(self.key(s), 0) for s in scopes)
+
+    def bump(self, *scopes):
+        """
+        Increment the counters of `scopes` and their types.
+
+        Returns the new value of every counter. Existing counters take one
+        round trip each.
+        """
+        cache = caches[settings.ATTENDANCE_CACHE]
+        scopes = set(scopes) | {s.split(":")[0] for s in scopes}
+        versions = dict()
+        for scope in scopes:
+            key = self.key(scope)
+            try:
+                versions[scope] = cache.incr(key)
+            except ValueError:
+                if cache.add(key, 1, None):
+                    versions[scope] = 1
+                else:
+                    versions[scope] = cache.incr(key)
+        return versions
+
+
+class LecturerCache(object):
+    """
+    Shared cache of lecturers by username.
+
+    Person IDs are kept for `ATTENDANCE_LECTURER_CACHE_TIMEOUT`, as are the
+    running holdings of each person together with the time they were
+    initiated. Holdings are dropped by the model signals in `models` when
+    one of the lecturer's holdings changes.
+    """
+
+    def key(self, *parts):
+        return ":".join([f"{__name__}.LecturerCache"] + [str(p) for p in parts])
+
+    def person(self, username):
+        from outpost.django.campusonline.models import Person
+
+        cache = caches[settings.ATTENDANCE_CACHE]
+        key = self.key("person", username)
+        cached = cache.get(key)
+        if cached is None:
+            person = (
+                Person.objects.filter(username=username)
+                .values_list("pk", flat=True)
+                .first()
+            )
+            cached = (person,)
+            cache.set(
+                key, cached, settings.ATTENDANCE_LECTURER_CACHE_TIMEOUT.total_seconds()
+            )
+        return cached[0]
+
+    def holdings(self, person):
+        from .models import CampusOnlineHolding
+
+        cache = caches[settings.ATTENDANCE_CACHE]
+        key = self.key("holdings", person)
+        cached = cache.get(key)
+        if cached is None:
+            cached = dict(
+                CampusOnlineHolding.objects.filter(lecturer=person, state="running")
+                .order_by()
+                .values_list("pk", "initiated")
+            )
+            cache.set(
+                key, cached, settings.ATTENDANCE_LECTURER_CACHE_TIMEOUT.total_seconds()
+            )
+        return cached
+
+    def invalidate(self, person):
+        cache = caches[settings.ATTENDANCE_CACHE]
+        cache.delete(self.key("holdings", person))
+
+
+terminals = TerminalCache()
+students = StudentCache()
+debounce = Debounce()
+preflights = PreflightCache()
+roomstates = RoomStateCache()
+changes = ChangeCounters()
+lecturers = LecturerCache()
@@ -14,6 +14,30 @@ class AttendanceAppConf(AppConf):
     STUDENT_MATRICULATION_UNMASKED = 3
     CAMPUSONLINE_ROOMALLOCATION_BUFFER_START = timedelta(minutes=15)
     CHECK_IMMUNIZATION = False
+    TERMINAL_CACHE_TIMEOUT = timedelta(minutes=1)
+    STUDENT_CACHE_SIZE = 4096
+    STUDENT_CACHE_TIMEOUT = timedelta(minutes=10)
+    STUDENT_CACHE_NEGATIVE_TIMEOUT = timedelta(seconds=30)
+    CACHE = "default"
+    CLOCK_DEBOUNCE = timedelta(seconds=5)
+    CLOCK_DEBOUNCE_WAIT = timedelta(seconds=2)
+    CLOCK_BATCH_SKEW = timedelta(minutes=1)
+    PREFLIGHT_CACHE_TIMEOUT = timedelta(seconds=30)
+    CAMPUSONLINE_OUTBOX_BATCH = 500
+    CAMPUSONLINE_OUTBOX_ATTEMPTS = 10
+    CAMPUSONLINE_OUTBOX_RETRY = timedelta(minutes=1)
+    ENTRY_CLEANUP_BATCH = 1000
+    ENTRY_CLEANUP_RESCAN = timedelta(days=7)
+    ROOMSTATE_TIMEOUT = timedelta(days=1)
+    ROOMSTATE_LOCK_WAIT = timedelta(seconds=1)
+    STREAM_BROKER = "outpost.django.attendance.events.CacheBroker"
+    STREAM_QUEUE = 256
+    STREAM_KEEPALIVE = timedelta(seconds=15)
+    STREAM_LIFETIME = timedelta(minutes=5)
+    STREAM_POLL = timedelta(milliseconds=500)
+    STREAM_RETENTION = timedelta(minutes=5)
+    CONDITIONAL_TIMEOUT = timedelta(minutes=1)
+    LECTURER_CACHE_TIMEOUT = timedelta(seconds=30)
 
     class Meta:
         prefix = "attendance"
@@ -0,0 +1,237 @@
+import json
+import logging
+from collections import deque
+from contextlib import contextmanager
+from queue import Empty, Full, Queue
+from threading import Lock
+from time import perf_counter, sleep
+
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker(object):
+    """
+    In-process publish/subscribe broker for change events.
+
+    Every subscriber gets a bounded queue per subscription. Events published
+    while a queue is full are dropped for that subscriber and the stream is
+    told to resynchronize. Only subscribers in the same process receive
+    events, so this is only suitable for tests and single process setups.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queues = dict()
+
+    def publish(self, topics, event):
+        self.publish_many([(topics, event)])
+
+    def publish_many(self, published):
+        for topics, event in published:
+            with self.lock:
+                queues = set().union(*(self.queues.get(t, set()) for t in topics))
+            for queue in queues:
+                try:
+                    queue.put_nowait(event)
+                except Full:
+                    logger.warn(f"Dropping event for slow subscriber: {event}")
+                    queue.overflow = True
+
+    @contextmanager
+    def subscribe(self, *topics):
+        queue = Queue(settings.ATTENDANCE_STREAM_QUEUE)
+        queue.overflow = False
+        with self.lock:
+            for topic in topics:
+                self.queues.setdefault(topic, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            with self.lock:
+                for topic in topics:
+                    subscribers = self.queues.get(topic, set())
+                    subscribers.discard(queue)
+                    if not subscribers:
+                        self.queues.pop(topic, None)
+
+
+class CacheSubscription(object):
+    """
+    Cursor over the topics of a `CacheBroker`, behaves like a `Queue`.
+    """
+
+    def __init__(self, broker, topics):
+        self.broker = broker
+        self.topics = topics
+        self.positions = dict(zip(topics, broker.heads(topics)))
+        self.missing = dict()
+        self.events = deque()
+        self.overflow = False
+
+    def poll(self):
+        cache = caches[settings.ATTENDANCE_CACHE]
+        limit = settings.ATTENDANCE_STREAM_QUEUE
+        keys = dict()
+        for topic, head in zip(self.topics, self.broker.heads(self.topics)):
+            position = self.positions[topic]
+            if head - position > limit:
+                self.overflow = True
+                position = self.positions[topic] = head - limit
+            for seq in range(position + 1, head + 1):
+                keys[self.broker.key(topic, seq)] = (topic, seq)
+        found = cache.get_many(keys)
+        now = perf_counter()
+        grace = settings.ATTENDANCE_STREAM_POLL.total_seconds() * 4
+        for key, (topic, seq) in keys.items():
+            if seq != self.positions[topic] + 1:
+                continue
+            if key not in found:
+                # The publisher might not have stored the event yet, give it
+                # a moment before treating it as lost.
+                if now - self.missing.setdefault(key, now) < grace:
+                    continue
+                self.overflow = True
+            else:
+                self.events.append(found[key])
+            self.missing.pop(key, None)
+            self.positions[topic] = seq
+
+    def get(self, timeout):
+        deadline = perf_counter() + timeout
+        while True:
+            if self.events:
+                return self.events.popleft()
+            self.poll()
+            if self.events:
+                continue
+            if perf_counter() > deadline:
+                raise Empty()
+            sleep(settings.ATTENDANCE_STREAM_POLL.total_seconds())
+
+
+class CacheBroker(object):
+    """
+    Publish/subscribe broker backed by the cache named by `ATTENDANCE_CACHE`.
+
+    Every topic has a sequence counter and each event is stored under its
+    sequence number for `ATTENDANCE_STREAM_RETENTION`, so events published
+    by any web or Celery process reach all subscribers sharing the cache.
+    Subscribers poll the counters every `ATTENDANCE_STREAM_POLL`. If a
+    subscriber falls behind by more than `ATTENDANCE_STREAM_QUEUE` events or
+    events expire before they are read, the stream is told to resynchronize.
+    """
+
+    def key(self, topic, seq=None):
+        if seq is None:
+            return f"{__name__}.CacheBroker:{topic}"
+        return f"{__name__}.CacheBroker:{topic}:{seq}"
+
+    def heads(self, topics):
+        cache = caches[settings.ATTENDANCE_CACHE]
+        heads = cache.get_many([self.key(t) for t in topics])
+        return [heads.get(self.key(t), 0) for t in topics]
+
+    def publish(self, topics, event):
+        self.publish_many([(topics, event)])
+
+    def publish_many(self, published):
+        """
+        Publish a list of topics and events with one counter increment per
+        topic and a single write for all events.
+        """
+        cache = caches[settings.ATTENDANCE_CACHE]
+        retention = settings.ATTENDANCE_STREAM_RETENTION.total_seconds()
+        grouped = dict()
+        for topics, event in published:
+            for topic in topics:
+                grouped.setdefault(topic, list()).append(event)
+        stored = dict()
+        for topic, events in grouped.items():
+            key = self.key(topic)
+            try:
+                head = cache.incr(key, len(events))
+            except ValueError:
+                if cache.add(key, len(events), None):
+                    head = len(events)
+                else:
+                    head = cache.incr(key, len(events))
+            first = head - len(events) + 1
+            for seq, event in enumerate(events, first):
+                stored[self.key(topic, seq)] = event
+        if stored:
+            cache.set_many(stored, retention)
+
+    @contextmanager
+    def subscribe(self, *topics):
+        yield CacheSubscription(self, topics)
+
+
+def topics(obj):
+    return [
+        f"{name}:{pk}"
+        for name, pk in (("holding", obj.holding_id), ("room", obj.room_id))
+        if pk is not None
+    ]
+
+
+def delta(obj, student, state=None):
+    """
+    Small representation of an entry that changed, `state` overrides the state
+    of the entry for rows that no longer exist.
+    """
+    return {
+        "type": obj._meta.model_name,
+        "id": obj.pk,
+        "holding": obj.holding_id,
+        "room": obj.room_id,
+        "student": student,
+        "state": state or obj.state,
+        "accredited": obj.accredited,
+        "assigned": obj.assigned,
+        "ended": obj.ended,
+    }
+
+
+def encode(event, name="change"):
+    data = json.dumps(event, cls=DjangoJSONEncoder)
+    return f"event: {name}\ndata: {data}\n\n"
+
+
+def stream(*topics):
+    """
+    Yield server-sent events for all changes published on `topics`.
+
+    Clients are expected to fetch the full state once the stream is open and
+    apply `change` events on top of it. A comment is sent every
+    `ATTENDANCE_STREAM_KEEPALIVE` without changes so proxies keep the
+    connection open. If events had to be dropped a `reset` event is sent and
+    clients should fetch the full state again. Streams end after
+    `ATTENDANCE_STREAM_LIFETIME` to free their worker, clients reconnect on
+    their own.
+    """
+    # Streams do not need the database, do not hold on to its connection
+    # for the lifetime of the stream.
+    connections.close_all()
+    timeout = settings.ATTENDANCE_STREAM_KEEPALIVE.total_seconds()
+    end = perf_counter() + settings.ATTENDANCE_STREAM_LIFETIME.total_seconds()
+    with broker.subscribe(*topics) as queue:
+        yield "retry: 1000\n\n"
+        while perf_counter() < end:
+            if queue.overflow:
+                queue.overflow = False
+                yield encode({"topics": list(topics)}, "reset")
+            try:
+                wait = max(0, min(timeout, end - perf_counter()))
+                yield encode(queue.get(timeout=wait))
+            except Empty:
+                yield ": keepalive\n\n"
+
+
+broker = import_string(settings.ATTENDANCE_STREAM_BROKER)()
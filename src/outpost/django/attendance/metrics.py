@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+from django.db import connection
+from prometheus_client import Counter, Gauge, Histogram
+
+student_cache = Counter(
+    "attendance_student_cache_total",
+    "Card ID lookups answered by the student cache",
+    ["result"],
+)
+
+clock_debounced = Counter(
+    "attendance_clock_debounced_total",
+    "Repeated swipes answered from the debounce cache",
+    ["terminal"],
+)
+
+clock_duration = Histogram(
+    "attendance_clock_duration_seconds",
+    "Time spent in each phase of a swipe",
+    ["phase", "plugin"],
+)
+
+clock_queries = Histogram(
+    "attendance_clock_queries",
+    "Database queries issued in each phase of a swipe",
+    ["phase", "plugin"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, float("inf")),
+)
+
+clock_query_duration = Histogram(
+    "attendance_clock_query_duration_seconds",
+    "Time spent in database queries in each phase of a swipe",
+    ["phase", "plugin"],
+)
+
+outbox_backlog = Gauge(
+    "attendance_campusonline_outbox_backlog",
+    "Rows in the CAMPUSonline outbox that are not flushed yet",
+)
+
+outbox_dead = Gauge(
+    "attendance_campusonline_outbox_dead",
+    "Rows in the CAMPUSonline outbox that are no longer retried",
+)
+
+outbox_flush = Histogram(
+    "attendance_campusonline_outbox_flush_seconds",
+    "Time spent flushing one batch of the CAMPUSonline outbox",
+)
+
+outbox_latency = Histogram(
+    "attendance_campusonline_outbox_latency_seconds",
+    "Time between queueing and flushing a CAMPUSonline outbox row",
+    buckets=(1, 5, 10, 30, 60, 300, 900, 3600, float("inf")),
+)
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += perf_counter() - start
+
+
+@contextmanager
+def observe(phase, plugin=""):
+    """
+    Record duration, query count and query time of a swipe phase.
+    """
+    counter = QueryCounter()
+    start = perf_counter()
+    try:
+        with connection.execute_wrapper(counter):
+            yield
+    finally:
+        clock_duration.labels(phase, plugin).observe(perf_counter() - start)
+        clock_queries.labels(phase, plugin).observe(counter.count)
+        clock_query_duration.labels(phase, plugin).observe(counter.duration)
+
+
+def instrument(phase, plugin, function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with observe(phase, plugin):
+            return function(*args, **kwargs)
+
+    return wrapper
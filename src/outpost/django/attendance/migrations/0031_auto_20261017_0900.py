@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-17 09:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("attendance", "0030_auto_20230919_1113"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="entry",
+            name="created",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.2.28 on 2026-10-17 09:30
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("attendance", "0031_auto_20261017_0900"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CampusOnlineOutbox",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "table",
+                    models.CharField(
+                        choices=[("lv_anw", "lv_anw"), ("stud_lv_anw", "stud_lv_anw")],
+                        max_length=32,
+                    ),
+                ),
+                ("origin", models.CharField(max_length=64)),
+                ("buchung_nr", models.IntegerField()),
+                (
+                    "data",
+                    django.contrib.postgres.fields.jsonb.JSONField(
+                        encoder=django.core.serializers.json.DjangoJSONEncoder
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("flushed", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("error", models.TextField(blank=True, null=True)),
+            ],
+            options={
+                "ordering": ("created",),
+                "unique_together": {("table", "origin", "buchung_nr")},
+            },
+        ),
+        migrations.AddIndex(
+            model_name="campusonlineoutbox",
+            index=models.Index(
+                fields=["flushed", "attempts"],
+                name="attendance_outbox_pending",
+            ),
+        ),
+    ]
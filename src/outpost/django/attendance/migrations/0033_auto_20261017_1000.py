@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("attendance", "0032_campusonlineoutbox"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="campusonlineholding",
+            index=models.Index(
+                fields=["state", "initiated"], name="attendance_holding_state"
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-17 10:30
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("attendance", "0033_auto_20261017_1000"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entry",
+            name="status",
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True, null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="entry",
+            name="student",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="attendance",
+                to="campusonline.Student",
+            ),
+        ),
+    ]
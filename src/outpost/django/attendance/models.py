@@ -1,11 +1,14 @@
 import logging
-from itertools import chain
 
 import django
 from django.contrib.postgres.fields import DateTimeRangeField, JSONField
-from django.db import models
-from django.db.models import Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Case, Exists, F, OuterRef, Q, Value, When
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext_lazy as _
 from django_fsm import FSMField, transition
 from django_prometheus.models import ExportModelOperationsMixin
@@ -14,14 +17,277 @@ from outpost.django.base.fields import ChoiceArrayField
 from outpost.django.base.models import NetworkedDeviceMixin, RelatedManager
 from outpost.django.base.utils import Uuid4Upload
 from outpost.django.base.validators import FileValidator
-from outpost.django.campusonline.models import CourseGroupTerm, Student
+from outpost.django.campusonline.models import CourseGroup, CourseGroupTerm, Student
 
+from . import events
+from .cache import changes, lecturers, preflights, roomstates, terminals
 from .conf import settings
 from .plugins import TerminalBehaviour
-from .tasks import CampusOnlineHoldingTasks
+from .signals import bulk_transition
+from .tasks import (
+    CampusOnlineEntryTasks,
+    CampusOnlineHoldingTasks,
+    CampusOnlineOutboxTasks,
+    ManualCampusOnlineEntryTasks,
+)
 
 logger = logging.getLogger(__name__)
 
+LV_ANW = (
+    "buchung_nr",
+    "grp_nr",
+    "lehrender_nr",
+    "termin_nr",
+    "lv_begin",
+    "lv_ende",
+)
+
+STUD_LV_ANW = (
+    "buchung_nr",
+    "stud_nr",
+    "grp_nr",
+    "termin_nr",
+    "anm_begin",
+    "anm_ende",
+)
+
+
+def campusonline_insert(table, columns, rows, chunk=1000):
+    """
+    Write rows to a CAMPUSonline attendance table using multi-row INSERTs.
+    """
+    from django.db import connection
+
+    rows = list(rows)
+    placeholder = f"({', '.join(['%s'] * len(columns))})"
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), chunk):
+            batch = rows[i : i + chunk]
+            query = f"""
+            INSERT INTO campusonline.{table} (
+                {", ".join(columns)}
+                ) VALUES {", ".join([placeholder] * len(batch))};
+            """
+            cursor.execute(query, [value for row in batch for value in row])
+
+
+class TransitionQuerySet(models.QuerySet):
+    """
+    Apply FSM transitions to all matching rows with a single UPDATE.
+
+    Only rows in one of the transition's source states are changed. The
+    primary keys of the changed rows are returned and sent with
+    `signals.bulk_transition` once the transaction commits.
+    """
+
+    def transition(self, name, source, target, **values):
+        if isinstance(source, str):
+            source = (source,)
+        with transaction.atomic():
+            pks = list(
+                self.filter(state__in=source)
+                .order_by()
+                .select_for_update()
+                .values_list("pk", flat=True)
+            )
+            if not pks:
+                return pks
+            self.model._base_manager.filter(pk__in=pks).update(
+                state=target, **values
+            )
+        logger.debug(f"{self.model.__name__} {pks}: {name} {source} -> {target}")
+        transaction.on_commit(
+            lambda: bulk_transition.send(
+                sender=self.model, pks=pks, name=name, source=source, target=target
+            )
+        )
+        return pks
+
+
+class CampusOnlineEntryQuerySet(TransitionQuerySet):
+    def cancel(self, entry=None):
+        return self.transition(
+            "cancel",
+            "created",
+            "canceled",
+            ended=entry.created if entry else timezone.now(),
+            outgoing=entry,
+        )
+
+    def assign(self, holding, assigned=None):
+        return self.transition(
+            "assign",
+            "created",
+            "assigned",
+            holding=holding,
+            assigned=assigned or timezone.now(),
+            accredited=Exists(
+                Entry.objects.filter(
+                    pk=OuterRef("incoming"),
+                    student__in=holding.course_group_term.coursegroup.students.values(
+                        "pk"
+                    ),
+                )
+            ),
+        )
+
+    def discard(self):
+        return self.transition(
+            "discard",
+            ("assigned", "left"),
+            "canceled",
+            assigned=None,
+            ended=timezone.now(),
+        )
+
+    def leave(self, entry=None):
+        return self.transition(
+            "leave",
+            "assigned",
+            "left",
+            ended=entry.created if entry else timezone.now(),
+            outgoing=entry,
+        )
+
+    def complete(self, finished=None, flush=True):
+        """
+        Complete entries and queue their bookings for CAMPUSonline.
+
+        Assigned entries end at `finished`, entries that left keep their end.
+        Students staying in the room for a following term get continuations
+        in the holding of their entry. `flush` is passed on to
+        `CampusOnlineOutbox.enqueue`.
+        """
+        finished = finished or timezone.now()
+        tz = timezone.get_current_timezone()
+        with transaction.atomic():
+            rows = list(
+                self.filter(state__in=("assigned", "left"))
+                .order_by()
+                .select_for_update(of=("self",))
+                .values_list(
+                    "pk",
+                    "incoming__student",
+                    "holding__course_group_term__coursegroup",
+                    "holding__course_group_term__term",
+                    "assigned",
+                    "ended",
+                    "state",
+                    "holding",
+                    "incoming",
+                )
+            )
+            if not rows:
+                return list()
+            logger.debug(f"Queueing {len(rows)} CO entries for CAMPUSonline")
+            CampusOnlineOutbox.enqueue(
+                CampusOnlineEntry,
+                "stud_lv_anw",
+                [
+                    (
+                        pk,
+                        student,
+                        group,
+                        term,
+                        assigned.astimezone(tz),
+                        (ended if state == "left" else finished).astimezone(tz),
+                    )
+                    for pk, student, group, term, assigned, ended, state, *rest in rows
+                ],
+                flush=flush,
+            )
+            pks = self.transition(
+                "complete",
+                ("assigned", "left"),
+                "complete",
+                ended=Case(
+                    When(state="assigned", then=Value(finished)),
+                    default=F("ended"),
+                    output_field=models.DateTimeField(),
+                ),
+            )
+            students = dict()
+            for pk, student, *rest, holding, incoming in rows:
+                students.setdefault(holding, dict())[student] = incoming
+            for holding in CampusOnlineHolding.objects.filter(
+                pk__in=list(students)
+            ).select_related("course_group_term"):
+                holding.continuation(students[holding.pk])
+        return pks
+
+
+class ManualCampusOnlineEntryQuerySet(TransitionQuerySet):
+    def discard(self):
+        return self.transition(
+            "discard",
+            ("assigned", "left"),
+            "canceled",
+            assigned=None,
+            ended=timezone.now(),
+        )
+
+    def leave(self):
+        return self.transition("leave", "assigned", "left", ended=timezone.now())
+
+    def complete(self, finished=None, flush=True):
+        """
+        Complete manual entries and queue their bookings for CAMPUSonline.
+
+        Assigned entries end at `finished`, entries that left keep their end.
+        `flush` is passed on to `CampusOnlineOutbox.enqueue`.
+        """
+        finished = finished or timezone.now()
+        tz = timezone.get_current_timezone()
+        with transaction.atomic():
+            rows = list(
+                self.filter(state__in=("assigned", "left"))
+                .order_by()
+                .select_for_update(of=("self",))
+                .values_list(
+                    "pk",
+                    "student",
+                    "holding__course_group_term__coursegroup",
+                    "holding__course_group_term__term",
+                    "assigned",
+                    "ended",
+                    "state",
+                )
+            )
+            if not rows:
+                return list()
+            logger.debug(f"Queueing {len(rows)} manual CO entries for CAMPUSonline")
+            CampusOnlineOutbox.enqueue(
+                ManualCampusOnlineEntry,
+                "stud_lv_anw",
+                [
+                    (
+                        pk,
+                        student,
+                        group,
+                        term,
+                        assigned.astimezone(tz),
+                        (ended if state == "left" else finished).astimezone(tz),
+                    )
+                    for pk, student, group, term, assigned, ended, state in rows
+                ],
+                flush=flush,
+            )
+            return self.transition(
+                "complete",
+                ("assigned", "left"),
+                "complete",
+                ended=Case(
+                    When(state="assigned", then=Value(finished)),
+                    default=F("ended"),
+                    output_field=models.DateTimeField(),
+                ),
+            )
+
+
+class StatisticsEntryQuerySet(TransitionQuerySet):
+    def complete(self, entry=None):
+        return self.transition("complete", "created", "completed", outgoing=entry)
+
 
 @signal_connect
 class Terminal(NetworkedDeviceMixin, models.Model):
@@ -58,8 +324,7 @@ class Terminal(NetworkedDeviceMixin, models.Model):
 
     @property
     def plugins(self):
-        pm = TerminalBehaviour.manager(lambda p: p.qualified() in self.behaviour)
-        return pm
+        return TerminalBehaviour.registry(self.behaviour)
 
     def pre_save(self, *args, **kwargs):
         if not self.pk:
@@ -72,19 +337,28 @@ class Terminal(NetworkedDeviceMixin, models.Model):
             return
         original.screen.delete(save=False)
 
+    def post_save(self, *args, **kwargs):
+        terminals.invalidate(self.pk)
+
+    def post_delete(self, *args, **kwargs):
+        terminals.invalidate(self.pk)
+
     def __str__(self):
         return self.hostname
 
 
 class Entry(ExportModelOperationsMixin("attendance.Entry"), models.Model):
     terminal = models.ForeignKey("Terminal", on_delete=models.CASCADE)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(default=timezone.now)
     student = models.ForeignKey(
         "campusonline.Student",
         models.DO_NOTHING,
         db_constraint=False,
+        null=True,
+        blank=True,
         related_name="attendance",
     )
+    status = JSONField(null=True, blank=True)
 
     class Meta:
         get_latest_by = "created"
@@ -96,6 +370,7 @@ class Entry(ExportModelOperationsMixin("attendance.Entry"), models.Model):
         return f"{s.student} [{s.created}: {s.terminal}]"
 
 
+@signal_connect
 class CampusOnlineHolding(
     ExportModelOperationsMixin("attendance.CampusOnlineHolding"), models.Model
 ):
@@ -135,12 +410,25 @@ class CampusOnlineHolding(
 
     class Meta:
         get_latest_by = "initiated"
+        indexes = (
+            models.Index(
+                fields=["state", "initiated"], name="attendance_holding_state"
+            ),
+        )
         permissions = (
             (("view_campusonlineholding", _("View CAMPUSonline Holding")),)
             if django.VERSION < (2, 1)
             else tuple()
         )
 
+    def post_save(self, *args, **kwargs):
+        bump(f"holding:{self.pk}", f"lecturer:{self.lecturer_id}")
+        transaction.on_commit(lambda: lecturers.invalidate(self.lecturer_id))
+
+    def post_delete(self, *args, **kwargs):
+        bump(f"holding:{self.pk}", f"lecturer:{self.lecturer_id}")
+        transaction.on_commit(lambda: lecturers.invalidate(self.lecturer_id))
+
     @transition(field=state, source="pending", target="running")
     def start(self):
         self.initiated = timezone.now()
@@ -167,104 +455,148 @@ class CampusOnlineHolding(
             start=self.course_group_term.start,
             end=self.course_group_term.end,
         ).exclude(pk=self.course_group_term.pk)
-        parallel_students = list(
-            chain(*[c.coursegroup.students.all() for c in parallel])
-        )
         coes = CampusOnlineEntry.objects.filter(
             room=self.room, holding=None, state="created"
+        ).annotate(
+            known=Exists(Student.objects.filter(pk=OuterRef("incoming__student"))),
+            parallel=Exists(
+                parallel.filter(coursegroup__students=OuterRef("incoming__student"))
+            ),
         )
-        for coe in coes:
-            try:
-                coe.incoming.student
-            except Student.DoesNotExist:
-                logger.warning(
-                    f"Removing entry with missing student (ID: {coe.incoming.student_id}"
-                )
-                coe.delete()
-                continue
-            # If there are parallel holdins, check if student is in a group
-            # other than the one started right now.
-            if parallel.exists():
-                if coe.incoming.student in parallel_students:
-                    # Student is officially part of another holding, skip them.
-                    # If a holding is started for their group, they will be
-                    # picked up then.
-                    continue
-            logger.debug(f"Assigning {coe} to {self}")
-            coe.assign(self)
-            coe.save()
+        missing = dict(coes.filter(known=False).values_list("pk", "incoming__student"))
+        if missing:
+            logger.warning(f"Removing entries with missing students (ID: {missing})")
+            CampusOnlineEntry.objects.filter(pk__in=list(missing)).delete()
+        # If there are parallel holdings, skip students who are officially part
+        # of another holding. If a holding is started for their group, they
+        # will be picked up then.
+        assigned = coes.filter(known=True, parallel=False).assign(
+            self, assigned=self.initiated
+        )
+        logger.info(f"Assigned {len(assigned)} entries to {self}: {assigned}")
 
     @transition(field=state, source="running", target="finished")
     def end(self, finished=None):
-        from django.db import connection
-
         logger.info(f"Ending holding {self}")
         self.finished = finished or timezone.now()
-
-        query = """
-        INSERT INTO campusonline.lv_anw (
-            buchung_nr,
-            grp_nr,
-            lehrender_nr,
-            termin_nr,
-            lv_begin,
-            lv_ende
-            ) VALUES (
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s
-            );
-        """
-        data = [
-            self.id,
-            self.course_group_term.coursegroup.id,
-            self.lecturer.pk,
-            self.course_group_term.term,
-            self.initiated.astimezone(timezone.get_current_timezone()),
-            self.finished.astimezone(timezone.get_current_timezone()),
-        ]
-        logger.debug(f"{self} writing to CAMPUSonline")
-        with connection.cursor() as cursor:
-            cursor.execute(query, data)
-
-        coes = self.entries.filter(state__in=("assigned", "left"))
-        mcoes = self.manual_entries.filter(state__in=("assigned", "left"))
-        for coe in coes:
-            coe.complete(finished=self.finished)
-            coe.save()
-        for mcoe in mcoes:
-            mcoe.complete(finished=self.finished)
-            mcoe.save()
-        CampusOnlineHoldingTasks.email_unaccredited.delay(
-            self.pk, [coe.pk for coe in coes], [mcoes.pk for mcoe in mcoes]
+        tz = timezone.get_current_timezone()
+        cgt = self.course_group_term
+        with transaction.atomic():
+            logger.debug(f"{self} queueing for CAMPUSonline")
+            CampusOnlineOutbox.enqueue(
+                CampusOnlineHolding,
+                "lv_anw",
+                [
+                    (
+                        self.id,
+                        cgt.coursegroup.id,
+                        self.lecturer.pk,
+                        cgt.term,
+                        self.initiated.astimezone(tz),
+                        self.finished.astimezone(tz),
+                    )
+                ],
+                flush=False,
+            )
+            coes = self.entries.complete(self.finished, flush=False)
+            mcoes = self.manual_entries.complete(self.finished, flush=False)
+            CampusOnlineOutbox.schedule()
+        logger.info(
+            f"Completed {len(coes)} entries and {len(mcoes)} manual entries for {self}"
+        )
+        transaction.on_commit(
+            lambda: CampusOnlineHoldingTasks.email_unaccredited.delay(
+                self.pk, coes, mcoes
+            )
         )
 
     @transition(field=state, source=("running", "pending"), target="canceled")
     def cancel(self):
         logger.info(f"Canceling holding {self}")
-        for coe in self.entries.filter(state__in=("assigned", "left")):
-            coe.discard()
-            coe.save()
-        for coe in self.manual_entries.filter(state__in=("assigned", "left")):
-            coe.discard()
-            coe.save()
+        self.entries.discard()
+        self.manual_entries.discard()
+
+    def continuation(self, students):
+        """
+        Create entries for students staying in the room for a following term.
+
+        `students` maps student IDs to the incoming entry they used to enter
+        the room. Terms starting within
+        `ATTENDANCE_CAMPUSONLINE_CONTINUATION_BUFFER` after this holding's
+        term are matched against all students with a single query.
+        """
+        if not students:
+            return list()
+        end = self.course_group_term.end
+        staying = (
+            CourseGroupTerm.objects.filter(
+                room=self.room,
+                coursegroup__students__in=list(students),
+                start__gt=end,
+                start__lt=end + settings.ATTENDANCE_CAMPUSONLINE_CONTINUATION_BUFFER,
+            )
+            .order_by()
+            .values_list("coursegroup__students", flat=True)
+            .distinct()
+        )
+        coes = CampusOnlineEntry.objects.bulk_create(
+            [
+                CampusOnlineEntry(incoming_id=students[student], room=self.room)
+                for student in staying
+            ]
+        )
+        if coes:
+            # Bulk inserts send no signals, propagate the new entries here.
+            pks = [coe.pk for coe in coes]
+            transaction.on_commit(lambda: CampusOnlineEntryTasks.propagate.delay(pks))
+        logger.debug(f"Created {len(coes)} continuations for {self}")
+        return coes
 
     @property
     def accredited(self):
         try:
-            for group in self.course_group_term.coursegroup.course.groups.all():
-                for student in group.students.all():
-                    yield student
+            return self._accredited
         except AttributeError:
             pass
+        try:
+            course = self.course_group_term.coursegroup.course_id
+        except AttributeError:
+            return Student.objects.none()
+        return Student.objects.filter(
+            pk__in=CourseGroup.objects.filter(course=course).values("students")
+        ).distinct()
+
+    @classmethod
+    def prefetch_accredited(cls, holdings):
+        """
+        Fill the accredited roster of many holdings with two queries.
+        """
+        holdings = list(holdings)
+        courses = dict()
+        for holding in holdings:
+            try:
+                courses[holding.pk] = holding.course_group_term.coursegroup.course_id
+            except AttributeError:
+                courses[holding.pk] = None
+        rosters = dict()
+        for course, student in CourseGroup.objects.filter(
+            course__in={c for c in courses.values() if c is not None},
+            students__isnull=False,
+        ).values_list("course", "students"):
+            rosters.setdefault(course, set()).add(student)
+        students = Student.objects.in_bulk(
+            {pk for roster in rosters.values() for pk in roster}
+        )
+        for holding in holdings:
+            roster = rosters.get(courses[holding.pk], set())
+            holding._accredited = [students[pk] for pk in roster if pk in students]
+        return holdings
 
     def __str__(s):
         return f"{s.course_group_term} [{s.lecturer}, {s.room}: {s.state}]"
 
 
+@signal_connect
 class CampusOnlineEntry(
     ExportModelOperationsMixin("attendance.CampusOnlineEntry"), models.Model
 ):
@@ -294,6 +626,8 @@ class CampusOnlineEntry(
     state = FSMField(default="created")
     accredited = models.BooleanField(default=False)
 
+    objects = CampusOnlineEntryQuerySet.as_manager()
+
     class Meta:
         ordering = ("incoming__created", "assigned", "ended")
         permissions = (
@@ -305,20 +639,28 @@ class CampusOnlineEntry(
     def __str__(s):
         return f"{s.incoming}: {s.state}"
 
+    def post_save(self, *args, **kwargs):
+        entry_changed("cards", self, self.incoming.student_id)
+
+    def post_delete(self, *args, **kwargs):
+        entry_changed("cards", self, self.incoming.student_id, "deleted")
+
     @transition(field=state, source="created", target="canceled")
     def cancel(self, entry=None):
         logger.debug(f"Canceling {self}")
-        self.ended = timezone.now()
+        self.ended = entry.created if entry else timezone.now()
         self.outgoing = entry
 
     @transition(field=state, source="created", target="assigned")
-    def assign(self, holding):
+    def assign(self, holding, accredited=None, assigned=None):
         logger.debug(f"Assigning {self} to {holding}")
         self.holding = holding
-        self.accredited = self.holding.course_group_term.coursegroup.students.filter(
-            pk=self.incoming.student.pk
-        ).exists()
-        self.assigned = timezone.now()
+        if accredited is None:
+            accredited = self.holding.course_group_term.coursegroup.students.filter(
+                pk=self.incoming.student_id
+            ).exists()
+        self.accredited = accredited
+        self.assigned = assigned or timezone.now()
 
     @transition(field=state, source=("assigned", "left"), target="canceled")
     def discard(self):
@@ -329,60 +671,33 @@ class CampusOnlineEntry(
     @transition(field=state, source="assigned", target="left")
     def leave(self, entry=None):
         logger.debug(f"{self} leaving")
-        self.ended = timezone.now()
+        self.ended = entry.created if entry else timezone.now()
         self.outgoing = entry
 
     @transition(field=state, source=("assigned", "left"), target="complete")
     def complete(self, entry=None, finished=None):
-        from django.db import connection
-
-        query = """
-        INSERT INTO campusonline.stud_lv_anw (
-            buchung_nr,
-            stud_nr,
-            grp_nr,
-            termin_nr,
-            anm_begin,
-            anm_ende
-            ) VALUES (
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s
-            );
-        """
         logger.debug(f"{self} completing")
         if self.state == "assigned":
             self.ended = finished or timezone.now()
         if entry:
             self.outgoing = entry
-        data = [
-            self.id,
-            self.incoming.student.id,
-            self.holding.course_group_term.coursegroup.id,
-            self.holding.course_group_term.term,
-            self.assigned.astimezone(timezone.get_current_timezone()),
-            self.ended.astimezone(timezone.get_current_timezone()),
-        ]
-        logger.debug(f"{self} writing to CAMPUSonline")
-        with connection.cursor() as cursor:
-            cursor.execute(query, data)
-        continuation = (
-            CourseGroupTerm.objects.filter(
-                room=self.room,
-                coursegroup__students=self.incoming.student,
-                start__gt=self.holding.course_group_term.end,
-                start__lt=self.holding.course_group_term.end
-                + settings.ATTENDANCE_CAMPUSONLINE_CONTINUATION_BUFFER,
-            )
-            .order_by("start")
-            .first()
+        tz = timezone.get_current_timezone()
+        logger.debug(f"{self} queueing for CAMPUSonline")
+        CampusOnlineOutbox.enqueue(
+            CampusOnlineEntry,
+            "stud_lv_anw",
+            [
+                (
+                    self.id,
+                    self.incoming.student_id,
+                    self.holding.course_group_term.coursegroup.id,
+                    self.holding.course_group_term.term,
+                    self.assigned.astimezone(tz),
+                    self.ended.astimezone(tz),
+                )
+            ],
         )
-        if continuation:
-            logger.debug(f"Creating continuation for {self}")
-            self.objects.create(incoming=self.incoming, room=self.room)
+        self.holding.continuation({self.incoming.student_id: self.incoming_id})
 
 
 @signal_connect
@@ -441,6 +756,8 @@ class ManualCampusOnlineEntry(
     state = FSMField(default="assigned")
     accredited = models.BooleanField(default=False)
 
+    objects = ManualCampusOnlineEntryQuerySet.as_manager()
+
     class Meta:
         ordering = ("assigned", "ended")
         permissions = (
@@ -469,6 +786,12 @@ class ManualCampusOnlineEntry(
             pk=self.student.pk
         ).exists()
 
+    def post_save(self, *args, **kwargs):
+        entry_changed("manuals", self, self.student_id)
+
+    def post_delete(self, *args, **kwargs):
+        entry_changed("manuals", self, self.student_id, "deleted")
+
     @transition(field=state, source=("assigned", "left"), target="canceled")
     def discard(self):
         logger.debug(f"Discarding {self}")
@@ -482,41 +805,102 @@ class ManualCampusOnlineEntry(
 
     @transition(field=state, source=("assigned", "left"), target="complete")
     def complete(self, finished=None):
-        from django.db import connection
-
-        query = """
-        INSERT INTO campusonline.stud_lv_anw (
-            buchung_nr,
-            stud_nr,
-            grp_nr,
-            termin_nr,
-            anm_begin,
-            anm_ende
-            ) VALUES (
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s
-            );
-        """
         logger.debug(f"{self} completing")
         if self.state == "assigned":
             self.ended = finished or timezone.now()
-        data = [
-            self.id,
-            self.student.id,
-            self.holding.course_group_term.coursegroup.id,
-            self.holding.course_group_term.term,
-            self.assigned.astimezone(timezone.get_current_timezone()),
-            self.ended.astimezone(timezone.get_current_timezone()),
+        tz = timezone.get_current_timezone()
+        logger.debug(f"{self} queueing for CAMPUSonline")
+        CampusOnlineOutbox.enqueue(
+            ManualCampusOnlineEntry,
+            "stud_lv_anw",
+            [
+                (
+                    self.id,
+                    self.student_id,
+                    self.holding.course_group_term.coursegroup.id,
+                    self.holding.course_group_term.term,
+                    self.assigned.astimezone(tz),
+                    self.ended.astimezone(tz),
+                )
+            ],
+        )
+
+
+class CampusOnlineOutbox(models.Model):
+    """
+    Pending writes to the CAMPUSonline attendance tables.
+
+    Rows are queued in the same transaction as the state change that caused
+    them and are written by `CampusOnlineOutboxTasks.flush`. Each booking
+    (`buchung_nr`) can only be queued once per table and origin, so repeated
+    transitions do not produce duplicate bookings.
+    """
+
+    tables = {"lv_anw": LV_ANW, "stud_lv_anw": STUD_LV_ANW}
+    timestamps = ("lv_begin", "lv_ende", "anm_begin", "anm_ende")
+
+    table = models.CharField(
+        max_length=32, choices=[(t, t) for t in sorted(tables.keys())]
+    )
+    origin = models.CharField(max_length=64)
+    buchung_nr = models.IntegerField()
+    data = JSONField(encoder=DjangoJSONEncoder)
+    created = models.DateTimeField(auto_now_add=True)
+    flushed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("created",)
+        unique_together = (("table", "origin", "buchung_nr"),)
+        indexes = (
+            models.Index(
+                fields=["flushed", "attempts"], name="attendance_outbox_pending"
+            ),
+        )
+
+    @classmethod
+    def enqueue(cls, origin, table, rows, flush=True):
+        """
+        Queue rows for a CAMPUSonline table.
+
+        A flush is scheduled once the transaction commits, unless `flush` is
+        `False` because the caller queues more rows and calls `schedule`
+        itself.
+        """
+        columns = cls.tables[table]
+        items = cls.objects.bulk_create(
+            [
+                cls(
+                    table=table,
+                    origin=origin._meta.label_lower,
+                    buchung_nr=row[0],
+                    data=dict(zip(columns, row)),
+                )
+                for row in rows
+            ],
+            ignore_conflicts=True,
+        )
+        if items and flush:
+            cls.schedule()
+        return items
+
+    @classmethod
+    def schedule(cls):
+        transaction.on_commit(CampusOnlineOutboxTasks.flush.delay)
+
+    @property
+    def values(self):
+        return [
+            parse_datetime(self.data[c]) if c in self.timestamps else self.data[c]
+            for c in self.tables[self.table]
         ]
-        logger.debug(f"{self} writing to CAMPUSonline")
-        with connection.cursor() as cursor:
-            cursor.execute(query, data)
+
+    def __str__(s):
+        return f"{s.table}:{s.buchung_nr} ({s.origin}: {s.flushed})"
 
 
+@signal_connect
 class Statistics(models.Model):
     name = models.CharField(max_length=256)
     active = DateTimeRangeField(null=True, blank=True)
@@ -530,10 +914,19 @@ class Statistics(models.Model):
             else tuple()
         )
 
+    def post_save(self, *args, **kwargs):
+        terminals.invalidate()
+        bump(f"statistics:{self.pk}")
+
+    def post_delete(self, *args, **kwargs):
+        terminals.invalidate()
+        bump(f"statistics:{self.pk}")
+
     def __str__(s):
         return f"{s.name} ({s.terminals.count()} Terminals / {s.active})"
 
 
+@signal_connect
 class StatisticsEntry(
     ExportModelOperationsMixin("attendance.StatisticsEntry"), models.Model
 ):
@@ -544,6 +937,8 @@ class StatisticsEntry(
     )
     state = FSMField(default="created")
 
+    objects = StatisticsEntryQuerySet.as_manager()
+
     class Meta:
         unique_together = (("statistics", "incoming"),)
         ordering = ("incoming__created",)
@@ -555,3 +950,91 @@ class StatisticsEntry(
 
     def __str__(s):
         return f"{s.statistics}: {s.incoming}/{s.outgoing}"
+
+    def post_save(self, *args, **kwargs):
+        bump(f"statistics:{self.statistics_id}")
+
+    def post_delete(self, *args, **kwargs):
+        bump(f"statistics:{self.statistics_id}")
+
+
+def bump(*scopes):
+    transaction.on_commit(lambda: changes.bump(*scopes))
+
+
+def entries_changed(kind, entries, state=None):
+    """
+    Return a callback propagating changes to `entries`.
+
+    `entries` is a list of entries and their student IDs, `state` overrides
+    their state for entries that were deleted. Counters are bumped before
+    the room state snapshots are updated, so a snapshot built concurrently
+    from stale data is never stored.
+    """
+    # Build events right away, the instances may change before the commit.
+    published = [(events.topics(e), events.delta(e, s, state)) for e, s in entries]
+    rooms = dict()
+    for entry, student in entries:
+        rooms.setdefault(entry.room_id, dict())[entry.pk] = None if state else entry
+
+    students = {student for _, student in entries}
+
+    def commit():
+        # Preflight answers depend on the open entry of the student.
+        for student in students:
+            preflights.invalidate(student)
+        versions = changes.bump(*{t for topics, _ in published for t in topics})
+        for room, changed in rooms.items():
+            roomstates.update(kind, room, changed, versions.get(f"room:{room}", 0))
+        events.broker.publish_many(published)
+
+    return commit
+
+
+def entry_changed(kind, entry, student, state=None):
+    transaction.on_commit(entries_changed(kind, [(entry, student)], state))
+
+
+def propagate(model, pks):
+    """
+    Propagate changes to many entries of `model` at once.
+    """
+    if model is CampusOnlineEntry:
+        kind, related = "cards", "incoming__student"
+    else:
+        kind, related = "manuals", "student"
+    entries = [
+        (obj, obj.incoming.student_id if kind == "cards" else obj.student_id)
+        for obj in model.objects.filter(pk__in=pks).select_related(related)
+    ]
+    entries_changed(kind, entries)()
+
+
+@receiver(bulk_transition, sender=CampusOnlineEntry)
+@receiver(bulk_transition, sender=ManualCampusOnlineEntry)
+def bulk_transitioned(sender, pks, **kwargs):
+    # Fanning out hundreds of changes would hold up the request ending a
+    # holding, leave it to a worker.
+    if sender is CampusOnlineEntry:
+        CampusOnlineEntryTasks.propagate.delay(pks)
+    else:
+        ManualCampusOnlineEntryTasks.propagate.delay(pks)
+
+
+@receiver(bulk_transition, sender=StatisticsEntry)
+def bulk_transitioned_statistics(sender, pks, **kwargs):
+    statistics = (
+        sender.objects.filter(pk__in=pks)
+        .order_by()
+        .values_list("statistics", flat=True)
+        .distinct()
+    )
+    changes.bump(*[f"statistics:{pk}" for pk in statistics])
+
+
+@receiver(m2m_changed, sender=Terminal.rooms.through)
+@receiver(m2m_changed, sender=Statistics.terminals.through)
+def invalidate_terminals(sender, action, **kwargs):
+    if action.startswith("post_"):
+        terminals.invalidate()
+        bump("room", "statistics")
@@ -2,7 +2,21 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from rest_framework.permissions import SAFE_METHODS, BasePermission
 
-from . import models
+from .cache import lecturers
+
+
+def lecturer(request):
+    """
+    Person ID and running holdings of the requesting user.
+
+    Resolved once per request from `cache.lecturers`, holdings map their
+    primary key to the time they were initiated.
+    """
+    if not hasattr(request, "_lecturer"):
+        person = lecturers.person(request.user.username)
+        holdings = lecturers.holdings(person) if person is not None else dict()
+        request._lecturer = (person, holdings)
+    return request._lecturer
 
 
 class ActiveCampusOnlineHoldingPermission(BasePermission):
@@ -13,9 +27,6 @@ class ActiveCampusOnlineHoldingPermission(BasePermission):
             return True
         # Find out if user has an active holding right now and see if the room
         # matches.
-        holdings = models.CampusOnlineHolding.objects.filter(
-            state="running",
-            initiated__lte=timezone.now(),
-            lecturer__username=request.user.username,
-        ).exists()
-        return holdings
+        holdings = lecturer(request)[1]
+        now = timezone.now()
+        return any(initiated and initiated <= now for initiated in holdings.values())
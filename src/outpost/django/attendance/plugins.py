@@ -1,13 +1,15 @@
 import logging
+from threading import Lock
 from typing import List
 
 import pluggy
 from django.core.exceptions import ObjectDoesNotExist
-from django.utils import timezone
+from django.db.models import Exists, OuterRef
 from django.utils.translation import gettext as _
 from outpost.django.base.plugins import Plugin
 from rest_framework.exceptions import NotFound
 
+from . import metrics
 from .conf import settings
 
 logger = logging.getLogger(__name__)
@@ -34,6 +36,34 @@ class TerminalBehaviour(object):
                 pm.register(plugin())
         return pm
 
+    managers = dict()
+    lock = Lock()
+
+    @classmethod
+    def registry(cls, behaviour):
+        """
+        Return a shared plugin manager for a list of qualified plugin names.
+
+        Managers are built once per distinct set of behaviours and kept for
+        the life of the process. Every hook implementation is wrapped to
+        record its latency and database usage.
+        """
+        key = tuple(sorted(set(behaviour)))
+        try:
+            return cls.managers[key]
+        except KeyError:
+            pass
+        with cls.lock:
+            if key not in cls.managers:
+                pm = cls.manager(lambda p: p.qualified() in key)
+                for name in ("preflight", "clock"):
+                    for impl in getattr(pm.hook, name).get_hookimpls():
+                        impl.function = metrics.instrument(
+                            name, impl.plugin.qualified(), impl.function
+                        )
+                cls.managers[key] = pm
+            return cls.managers[key]
+
     @hookspec
     def preflight(self, terminal, student) -> List[dict]:
         """"""
@@ -67,7 +97,8 @@ class CampusOnlineTerminalBehaviour(TerminalBehaviourPlugin):
         from .models import CampusOnlineEntry
 
         # import pudb ; pu.db
-        if terminal.rooms.count() < 2:
+        rooms = terminal.rooms.all()
+        if len(rooms) < 2:
             return
         try:
             coe = CampusOnlineEntry.objects.get(
@@ -80,19 +111,20 @@ class CampusOnlineTerminalBehaviour(TerminalBehaviourPlugin):
         return {
             "id": f"{self.__class__.__name__}:room",
             "question": _("Please select room"),
-            "options": {r.pk: str(r) for r in terminal.rooms.all()},
+            "options": {r.pk: str(r) for r in rooms},
         }
 
     @TerminalBehaviour.hookimpl
     def clock(self, entry, payload):
+        from outpost.django.campusonline.models import CourseGroupTerm
         from .models import CampusOnlineHolding, CampusOnlineEntry
 
         # import pudb ; pu.db
         logger.debug(f"{self.__class__.__name__}: create({entry})")
         try:
-            coe = CampusOnlineEntry.objects.get(
-                incoming__student=entry.student, ended__isnull=True
-            )
+            coe = CampusOnlineEntry.objects.select_related(
+                "holding__course_group_term__coursegroup", "incoming"
+            ).get(incoming__student=entry.student, ended__isnull=True)
             # Existing entry, student leaving room
             logger.debug(f"Student {entry.student} leaving {coe.room}")
             if not coe.holding:
@@ -115,41 +147,44 @@ class CampusOnlineTerminalBehaviour(TerminalBehaviourPlugin):
                     msg = _("Goodbye")
         except CampusOnlineEntry.DoesNotExist:
             # New entry, student entering the room
-            room_count = entry.terminal.rooms.count()
-            if room_count == 0:
-                logger.warn(
-                    f"Terminal {entry.incoming.terminal} has no rooms assigned."
-                )
+            rooms = entry.terminal.rooms.all()
+            if len(rooms) == 0:
+                logger.warn(f"Terminal {entry.terminal} has no rooms assigned.")
                 raise NotFound(_(f"Terminal has no suitable rooms assigned."))
-            elif room_count == 1:
-                room = entry.terminal.rooms.first()
+            elif len(rooms) == 1:
+                room = rooms[0]
             else:
-                room_id = payload.get(f"{self.__class__.__name__}:room")
+                room_id = str(payload.get(f"{self.__class__.__name__}:room"))
                 try:
-                    room = entry.terminal.rooms.get(pk=room_id)
-                except entry.terminal.rooms.model.DoesNotExist:
+                    room = next(r for r in rooms if str(r.pk) == room_id)
+                except StopIteration:
                     logger.warn(
-                        f"Terminal {entry.incoming.terminal} has no room with PK {room_id} assigned."
+                        f"Terminal {entry.terminal} has no room with PK {room_id} assigned."
                     )
                     raise NotFound(_(f"No such room found for terminal."))
-            coe = CampusOnlineEntry.objects.create(incoming=entry, room=room)
+            coe = CampusOnlineEntry(incoming=entry, room=room)
             logger.debug(f"Student {entry.student} entering {room}")
-            holdings = CampusOnlineHolding.objects.filter(
-                room=room, initiated__lte=timezone.now(), state="running"
+            # Prefer a running holding whose course group lists the student.
+            # TODO: Find a better way to handle unoffical attendants with
+            # multiple parallel holdings. Right now it assigns to the first
+            # holding from all parallel ones.
+            holding = (
+                CampusOnlineHolding.objects.filter(
+                    room=room, initiated__lte=entry.created, state="running"
+                )
+                .annotate(
+                    member=Exists(
+                        CourseGroupTerm.objects.filter(
+                            pk=OuterRef("course_group_term"),
+                            coursegroup__students=entry.student,
+                        )
+                    )
+                )
+                .order_by("-member", "pk")
+                .first()
             )
-            if holdings.count() > 0:
-                for holding in holdings:
-                    if (
-                        entry.student
-                        in holding.course_group_term.coursegroup.students.all()
-                    ):
-                        coe.assign(holding)
-                        break
-                else:
-                    # TODO: Find a better way to handle unoffical attendants
-                    # with multiple parallel holdings. Right now it assigns to
-                    # the first holding from all parallel ones.
-                    coe.assign(holdings.first())
+            if holding:
+                coe.assign(holding, accredited=holding.member, assigned=entry.created)
                 msg = _(
                     f"Welcome {coe.incoming.student.display} to {coe.holding.course_group_term.coursegroup}".format(
                         coe=coe
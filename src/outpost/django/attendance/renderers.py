@@ -0,0 +1,20 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Renderer for `text/event-stream` responses.
+
+    Streams are returned as `StreamingHttpResponse` and never rendered, this
+    only serves content negotiation and errors raised before the stream
+    starts, which are sent as a single `error` event.
+    """
+
+    media_type = "text/event-stream"
+    format = "event-stream"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return f"event: error\ndata: {json.dumps(data)}\n\n".encode(self.charset)
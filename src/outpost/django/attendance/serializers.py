@@ -39,6 +39,12 @@ class TerminalSerializer(FlexFieldsModelSerializer):
         fields = ("id", "rooms", "config", "screen")
 
 
+class ClockBatchSerializer(serializers.Serializer):
+    cardid = serializers.RegexField(r"^[\dA-F]{8}$")
+    created = serializers.DateTimeField()
+    payload = serializers.DictField(required=False, default=dict)
+
+
 class EntrySerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Entry
@@ -213,101 +219,89 @@ class ManualCampusOnlineEntrySerializer(FlexFieldsModelSerializer):
         read_only_fields = ("id", "assigned", "ended", "state", "accredited")
 
 
-class RoomStateCampusOnlineEntrySerializer(CampusOnlineEntrySerializer):
-    onsite = serializers.SerializerMethodField()
-
-    def __init__(self, *args, **kwargs):
-        self.hybrid = kwargs.pop("hybrid", False)
-        super().__init__(*args, **kwargs)
-
-    class Meta(CampusOnlineEntrySerializer.Meta):
-        fields = CampusOnlineEntrySerializer.Meta.fields + ("onsite",)
-
-    def get_onsite(self, obj):
-        if not self.hybrid:
-            return None
-        return RoomAllocation.objects.filter(
-            student=obj.incoming.student,
-            room=obj.room,
-            start__lte=timezone.now()
-            + settings.ATTENDANCE_CAMPUSONLINE_ROOMALLOCATION_BUFFER_START,
-            end__gte=timezone.now(),
-            onsite=True,
-        ).exists()
-
-
-class RoomStateManualCampusOnlineEntrySerializer(ManualCampusOnlineEntrySerializer):
-    onsite = serializers.SerializerMethodField()
-
-    def __init__(self, *args, **kwargs):
-        self.hybrid = kwargs.pop("hybrid", False)
-        super().__init__(*args, **kwargs)
-
-    class Meta(ManualCampusOnlineEntrySerializer.Meta):
-        fields = ManualCampusOnlineEntrySerializer.Meta.fields + ("onsite",)
-
-    def get_onsite(self, obj):
-        if not self.hybrid:
-            return None
-        return RoomAllocation.objects.filter(
-            student=obj.student,
-            room=obj.room,
-            start__lte=timezone.now()
-            + settings.ATTENDANCE_CAMPUSONLINE_ROOMALLOCATION_BUFFER_START,
-            end__gte=timezone.now(),
-            onsite=True,
-        ).exists()
+class RoomStateListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        rooms = list(data.all() if hasattr(data, "all") else data)
+        self.child.prefetch(rooms)
+        return super().to_representation(rooms)
 
 
 class RoomStateSerializer(serializers.ModelSerializer):
-    """"""
+    """
+    Entries are served from the snapshots kept in `cache.roomstates`, the
+    `version` of a room changes whenever one of its entries does. Hybrid
+    status is expected as an `hybrid` annotation on the rooms and is only
+    queried per room if it is missing. Onsite allocations are fetched once
+    for all rooms that are serialized together.
+    """
 
+    version = serializers.SerializerMethodField()
     hybrid = serializers.SerializerMethodField()
     cards = serializers.SerializerMethodField()
     manuals = serializers.SerializerMethodField()
 
     class Meta:
         model = Room
+        list_serializer_class = RoomStateListSerializer
         fields = (
             "id",
+            "version",
             "cards",
             "manuals",
             "hybrid",
         )
-        read_only_fields = ("id", "cards", "manuals", "hybrid")
+        read_only_fields = ("id", "version", "cards", "manuals", "hybrid")
 
-    def get_hybrid(self, obj):
-        return obj.roomallocation_set.filter(
-            start__lte=timezone.now()
+    @staticmethod
+    def allocations(now):
+        return RoomAllocation.objects.filter(
+            start__lte=now
             + settings.ATTENDANCE_CAMPUSONLINE_ROOMALLOCATION_BUFFER_START,
-            end__gte=timezone.now(),
-        ).exists()
+            end__gte=now,
+        )
+
+    def prefetch(self, rooms):
+        from .cache import roomstates
+
+        now = timezone.now()
+        self.state = {
+            pk: dict(snapshot, onsite=None)
+            for pk, snapshot in roomstates.get_many([r.pk for r in rooms]).items()
+        }
+        hybrid = [r.pk for r in rooms if self.get_hybrid(r)]
+        for pk in hybrid:
+            self.state[pk]["onsite"] = set()
+        if hybrid:
+            onsite = self.allocations(now).filter(room__in=hybrid, onsite=True)
+            for room, student in onsite.values_list("room", "student"):
+                self.state[room]["onsite"].add(student)
+
+    def get_state(self, obj):
+        if obj.pk not in getattr(self, "state", dict()):
+            self.prefetch([obj])
+        return self.state[obj.pk]
+
+    def entries(self, obj, kind):
+        state = self.get_state(obj)
+        onsite = state["onsite"]
+        return [
+            dict(data, onsite=None if onsite is None else student in onsite)
+            for pk, (student, data) in sorted(state[kind].items())
+        ]
+
+    def get_version(self, obj):
+        return self.get_state(obj)["version"]
+
+    def get_hybrid(self, obj):
+        if not hasattr(obj, "hybrid"):
+            obj.hybrid = self.allocations(timezone.now()).filter(room=obj).exists()
+        return obj.hybrid
 
     def get_cards(self, obj):
-        coes = (
-            models.CampusOnlineEntry.objects.filter(
-                room=obj,
-                state__in=("created", "assigned"),
-                incoming__created__date=timezone.now().date(),
-            )
-            .distinct()
-            .select_related("incoming__student")
-        )
-        return RoomStateCampusOnlineEntrySerializer(
-            coes, many=True, expand=["student"], hybrid=self.get_hybrid(obj)
-        ).data
+        return self.entries(obj, "cards")
 
     def get_manuals(self, obj):
-        mcoes = (
-            models.ManualCampusOnlineEntry.objects.filter(
-                room=obj, state="assigned", assigned__date=timezone.now().date()
-            )
-            .distinct()
-            .select_related("student")
-        )
-        return RoomStateManualCampusOnlineEntrySerializer(
-            mcoes, many=True, expand=["student"], hybrid=self.get_hybrid(obj)
-        ).data
+        return self.entries(obj, "manuals")
 
 
 class StatisticsEntrySerializer(serializers.ModelSerializer):
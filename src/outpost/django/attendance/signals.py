@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent once per queryset-level transition after the transaction commits.
+bulk_transition = Signal(providing_args=["pks", "name", "source", "target"])
@@ -1,19 +1,85 @@
 import logging
+from bisect import bisect_left, bisect_right
 from datetime import timedelta
 
 from celery import shared_task
+from django.core.cache import caches
 from django.core.mail import EmailMultiAlternatives
-from django.db.models import Q
+from django.db import DatabaseError, transaction
+from django.db.models import (
+    Count,
+    DateTimeField,
+    DurationField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    Max,
+    OuterRef,
+    Q,
+)
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from outpost.django.campusonline.models import CourseGroupTerm
 
+from . import metrics
 from .conf import settings
 
 logger = logging.getLogger(__name__)
 
 
+class Timetable(object):
+    """
+    Course group terms of one room on one day, sorted by start.
+    """
+
+    def __init__(self):
+        self.starts = list()
+        self.terms = list()
+
+    def add(self, cgt):
+        i = bisect_right(self.starts, cgt.start)
+        self.starts.insert(i, cgt.start)
+        self.terms.insert(i, cgt)
+
+    def current(self, timestamp, lifetime):
+        """
+        First term starting before `timestamp + lifetime` that has not ended
+        at `timestamp`.
+        """
+        for cgt in self.terms[: bisect_right(self.starts, timestamp + lifetime)]:
+            if cgt.end >= timestamp:
+                return cgt
+
+    def following(self, cgt):
+        """
+        First term starting at or after the end of `cgt`.
+        """
+        i = bisect_left(self.starts, cgt.end)
+        if i < len(self.terms):
+            return self.terms[i]
+
+    def expired(self, created, now, lifetime, buffer):
+        """
+        Whether an unassigned entry created at `created` can be canceled.
+        """
+        cgt = self.current(created, lifetime)
+        if not cgt:
+            # There is no planned holding left for today, keep the entry for
+            # its lifetime.
+            return created + lifetime <= now
+        if created > cgt.start:
+            # Entry is within planned holding, look for start of next planned
+            # holding.
+            following = self.following(cgt)
+            if following and following.start - buffer < created:
+                # Entry was created within buffer ahead of the following
+                # holding.
+                return False
+        # Expired once the holding is over according to its planned time.
+        return cgt.end <= now
+
+
 class CampusOnlineHoldingTasks:
     @shared_task(
         bind=True,
@@ -66,35 +132,73 @@ class CampusOnlineHoldingTasks:
         """
         from .models import CampusOnlineHolding
 
-        now = timezone.now()
-        for h in CampusOnlineHolding.objects.filter(state="running"):
-            period = h.course_group_term.end - h.course_group_term.start
-            if (
-                h.initiated
-                + period
-                + settings.ATTENDANCE_CAMPUSONLINE_HOLDING_OVERDRAFT
-                < now
-            ):
-                h.end(finished=h.initiated + period)
+        overdue = (
+            CampusOnlineHolding.objects.filter(state="running")
+            .annotate(
+                planned=ExpressionWrapper(
+                    F("initiated")
+                    + ExpressionWrapper(
+                        F("course_group_term__end") - F("course_group_term__start"),
+                        output_field=DurationField(),
+                    ),
+                    output_field=DateTimeField(),
+                )
+            )
+            .filter(
+                planned__lt=timezone.now()
+                - settings.ATTENDANCE_CAMPUSONLINE_HOLDING_OVERDRAFT
+            )
+        )
+        for h in overdue:
+            logger.info(f"Ending overdue holding {h}")
+            with transaction.atomic():
+                h.end(finished=h.planned)
                 h.save()
 
 
 class EntryTasks:
     @shared_task(bind=True, ignore_result=True, name=f"{__name__}.Entry:cleanup")
     def cleanup(task):
+        """
+        Unlink entries whose student no longer exists in CAMPUSonline.
+
+        Orphans are found with an anti-join against the students and read in
+        batches of `ATTENDANCE_ENTRY_CLEANUP_BATCH` through a server-side
+        cursor. Only entries newer than the last verified one are scanned,
+        except for a full rescan every `ATTENDANCE_ENTRY_CLEANUP_RESCAN`.
+        """
         from outpost.django.campusonline.models import Student
         from .models import Entry
 
-        for e in Entry.objects.all():
-            try:
-                Student.objects.get(pk=e.student_id)
-            except Student.DoesNotExist:
-                logger.warn(f"Removing student {e.student_id} link for entry {e.pk}")
-                if not e.status:
-                    e.status = dict()
-                e.status["student"] = e.student_id
-                e.student = None
-                e.save()
+        cache = caches[settings.ATTENDANCE_CACHE]
+        key = f"{__name__}.EntryTasks:cleanup"
+        now = timezone.now()
+        mark = cache.get(key)
+        if not mark or mark["rescan"] < now:
+            logger.info("Scanning all entries for missing students")
+            mark = {"pk": 0, "rescan": now + settings.ATTENDANCE_ENTRY_CLEANUP_RESCAN}
+        latest = Entry.objects.aggregate(pk=Max("pk"))["pk"] or 0
+        orphans = (
+            Entry.objects.filter(
+                pk__gt=mark["pk"], pk__lte=latest, student__isnull=False
+            )
+            .annotate(known=Exists(Student.objects.filter(pk=OuterRef("student"))))
+            .filter(known=False)
+            .order_by("pk")
+            .only("pk", "student", "status")
+        )
+        batch = list()
+        for e in orphans.iterator(chunk_size=settings.ATTENDANCE_ENTRY_CLEANUP_BATCH):
+            logger.warn(f"Removing student {e.student_id} link for entry {e.pk}")
+            e.status = dict(e.status or dict(), student=e.student_id)
+            e.student = None
+            batch.append(e)
+            if len(batch) >= settings.ATTENDANCE_ENTRY_CLEANUP_BATCH:
+                Entry.objects.bulk_update(batch, ("status", "student"))
+                batch = list()
+        if batch:
+            Entry.objects.bulk_update(batch, ("status", "student"))
+        cache.set(key, {"pk": latest, "rescan": mark["rescan"]}, None)
 
 
 class CampusOnlineEntryTasks:
@@ -125,36 +229,174 @@ class CampusOnlineEntryTasks:
         from .models import CampusOnlineEntry
 
         now = timezone.now()
+        lifetime = settings.ATTENDANCE_CAMPUSONLINE_ENTRY_LIFETIME
+        buffer = settings.ATTENDANCE_CAMPUSONLINE_ENTRY_BUFFER_END
         logger.info(f"Cleaning up CO entries")
-        for e in CampusOnlineEntry.objects.filter(state="created"):
-            cgt_base = CourseGroupTerm.objects.filter(
-                room=e.room, start__date=e.created, end__date=e.created
-            ).order_by("start")
-            # Check for next or current CGT
-            cgt = cgt_base.filter(
-                start__lte=e.created + settings.ATTENDANCE_CAMPUSONLINE_ENTRY_LIFETIME,
-                end__gte=e.created,
-            ).first()
-            if not cgt:
-                # The is no planned holding left for today.
-                if e.created + settings.ATTENDANCE_CAMPUSONLINE_ENTRY_LIFETIME > now:
-                    # CO entry still inside entry lifetime, do nothing.
-                    continue
-            else:
-                if e.created > cgt.start:
-                    # CO entry is within planned holding, look for start of
-                    # next planned holding.
-                    cgt_next = cgt_base.filter(start__gte=cgt.end).first()
-                    if (
-                        cgt_next.start - settings.ATTENDANCE_CAMPUSONLINE_ENTRY_BUFFER
-                        < e.created
-                    ):
-                        # CO entry was created within buffer ahead of the
-                        # following holding, do nothing.
-                        continue
-                if cgt.end > now:
-                    # Holding is still within planned time range, do nothing.
-                    continue
-            logger.debug(f"Canceling CO entry {e}")
-            e.cancel()
-            e.save()
+        entries = [
+            (pk, room, created, timezone.localtime(created).date())
+            for pk, room, created in CampusOnlineEntry.objects.filter(
+                state="created"
+            ).values_list("pk", "room", "incoming__created")
+        ]
+        if not entries:
+            return
+        timetables = dict()
+        for cgt in CourseGroupTerm.objects.filter(
+            room__in={room for _, room, _, _ in entries},
+            start__date__in={day for _, _, _, day in entries},
+        ).order_by("start"):
+            day = timezone.localtime(cgt.start).date()
+            if day != timezone.localtime(cgt.end).date():
+                continue
+            timetables.setdefault((cgt.room_id, day), Timetable()).add(cgt)
+        cancel = [
+            pk
+            for pk, room, created, day in entries
+            if timetables.get((room, day), Timetable()).expired(
+                created, now, lifetime, buffer
+            )
+        ]
+        canceled = CampusOnlineEntry.objects.filter(pk__in=cancel).cancel()
+        logger.info(f"Canceled {len(canceled)} CO entries: {canceled}")
+
+    @shared_task(
+        bind=True, ignore_result=True, name=f"{__name__}.CampusOnlineEntry:propagate"
+    )
+    def propagate(task, pks):
+        """
+        Propagate bulk changes of CO entries to counters, room states and
+        streams outside of the request that caused them.
+        """
+        from .models import CampusOnlineEntry, propagate
+
+        propagate(CampusOnlineEntry, pks)
+
+
+class ManualCampusOnlineEntryTasks:
+    @shared_task(
+        bind=True,
+        ignore_result=True,
+        name=f"{__name__}.ManualCampusOnlineEntry:propagate",
+    )
+    def propagate(task, pks):
+        """
+        Propagate bulk changes of manual CO entries to counters, room states and
+        streams outside of the request that caused them.
+        """
+        from .models import ManualCampusOnlineEntry, propagate
+
+        propagate(ManualCampusOnlineEntry, pks)
+
+
+def measure_outbox():
+    from .models import CampusOnlineOutbox
+
+    attempts = settings.ATTENDANCE_CAMPUSONLINE_OUTBOX_ATTEMPTS
+    counts = CampusOnlineOutbox.objects.filter(flushed=None).aggregate(
+        backlog=Count("pk"), dead=Count("pk", filter=Q(attempts__gte=attempts))
+    )
+    metrics.outbox_backlog.set(counts["backlog"])
+    metrics.outbox_dead.set(counts["dead"])
+    return counts
+
+
+class CampusOnlineOutboxTasks:
+    @shared_task(
+        bind=True,
+        ignore_result=True,
+        max_retries=None,
+        name=f"{__name__}.CampusOnlineOutbox:flush",
+    )
+    def flush(task):
+        """
+        Write queued rows from the outbox to CAMPUSonline.
+
+        Rows are taken in batches of `ATTENDANCE_CAMPUSONLINE_OUTBOX_BATCH`,
+        `lv_anw` before `stud_lv_anw`, and written with multi-row INSERTs. A
+        row is marked as flushed in the same transaction as its INSERT. If a
+        batch fails, its rows are retried one by one so a single broken row
+        does not block the others. Failed rows are retried on later runs
+        until `ATTENDANCE_CAMPUSONLINE_OUTBOX_ATTEMPTS` is reached.
+        """
+        from .models import CampusOnlineOutbox, campusonline_insert
+
+        pending = CampusOnlineOutbox.objects.filter(
+            flushed=None,
+            attempts__lt=settings.ATTENDANCE_CAMPUSONLINE_OUTBOX_ATTEMPTS,
+        )
+        failed = False
+        while True:
+            start = timezone.now()
+            with transaction.atomic():
+                batch = list(
+                    pending.select_for_update(skip_locked=True).order_by(
+                        "table", "created"
+                    )[: settings.ATTENDANCE_CAMPUSONLINE_OUTBOX_BATCH]
+                )
+                if not batch:
+                    break
+                done = list()
+                errors = dict()
+                try:
+                    with transaction.atomic():
+                        for table in ("lv_anw", "stud_lv_anw"):
+                            campusonline_insert(
+                                table,
+                                CampusOnlineOutbox.tables[table],
+                                [o.values for o in batch if o.table == table],
+                            )
+                    done = batch
+                except DatabaseError as e:
+                    logger.warn(f"Flushing outbox batch failed, retrying rows: {e}")
+                    for o in batch:
+                        try:
+                            with transaction.atomic():
+                                campusonline_insert(
+                                    o.table,
+                                    CampusOnlineOutbox.tables[o.table],
+                                    [o.values],
+                                )
+                            done.append(o)
+                        except DatabaseError as e:
+                            logger.error(f"Flushing {o} failed: {e}")
+                            errors[o.pk] = str(e)
+                now = timezone.now()
+                CampusOnlineOutbox.objects.filter(
+                    pk__in=[o.pk for o in done]
+                ).update(flushed=now)
+                for pk, error in errors.items():
+                    CampusOnlineOutbox.objects.filter(pk=pk).update(
+                        attempts=F("attempts") + 1, error=error
+                    )
+            metrics.outbox_flush.observe((now - start).total_seconds())
+            for o in done:
+                metrics.outbox_latency.observe((now - o.created).total_seconds())
+            logger.info(f"Flushed {len(done)} rows from outbox, {len(errors)} failed")
+            if errors:
+                failed = True
+                break
+        measure_outbox()
+        if failed:
+            raise task.retry(
+                countdown=settings.ATTENDANCE_CAMPUSONLINE_OUTBOX_RETRY.total_seconds()
+            )
+
+    @shared_task(
+        bind=True, ignore_result=True, name=f"{__name__}.CampusOnlineOutbox:sweep"
+    )
+    def sweep(task):
+        """
+        Periodically drain the outbox and refresh its metrics.
+
+        Flushes are normally triggered when rows are queued, this picks up
+        rows whose trigger was lost or which are waiting for a retry. Meant to
+        run from the beat schedule every few minutes, like the cleanup tasks.
+        Rows that reached `ATTENDANCE_CAMPUSONLINE_OUTBOX_ATTEMPTS` are only
+        counted and need their attempts reset in the admin.
+        """
+        counts = measure_outbox()
+        if counts["backlog"] > counts["dead"]:
+            logger.info(f"Sweeping {counts['backlog'] - counts['dead']} outbox rows")
+            CampusOnlineOutboxTasks.flush.delay()
+        if counts["dead"]:
+            logger.error(f"{counts['dead']} outbox rows exceeded their attempts")
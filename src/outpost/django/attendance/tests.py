@@ -1,3 +1,510 @@
-from django.test import TestCase
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from queue import Empty
+from time import perf_counter
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from outpost.django.campusonline import models as co
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from . import api, events, models, views
+from .cache import changes, debounce, lecturers, terminals
+from .permissions import ActiveCampusOnlineHoldingPermission
+from .plugins import CampusOnlineTerminalBehaviour
+from .tasks import Timetable
+
+
+class CampusOnlineFixturesMixin(object):
+    def setUp(self):
+        now = timezone.now()
+        self.lecturer = co.Person.objects.create(pk=1, username="lecturer")
+        self.course = co.Course.objects.create(pk=1)
+        self.start = now - timedelta(minutes=5)
+        self.end = now + timedelta(minutes=85)
+        terminals.invalidate()
+
+    def create_room(self, pk, **kwargs):
+        room = co.Room.objects.create(pk=pk)
+        terminal = models.Terminal.objects.create(
+            hostname=f"terminal-{pk}", enabled=True, online=True, **kwargs
+        )
+        terminal.rooms.add(room)
+        return room, terminal
+
+    def create_holding(self, pk, room, size):
+        group = co.CourseGroup.objects.create(pk=pk, course=self.course)
+        group.students.add(
+            *[
+                co.Student.objects.create(pk=f"{pk}-{i}", cardid=f"{pk:04X}{i:04X}")
+                for i in range(size)
+            ]
+        )
+        cgt = co.CourseGroupTerm.objects.create(
+            pk=pk,
+            coursegroup=group,
+            person=self.lecturer,
+            room=room,
+            term=pk,
+            start=self.start,
+            end=self.end,
+        )
+        return models.CampusOnlineHolding.objects.create(
+            course_group_term=cgt,
+            room=room,
+            lecturer=self.lecturer,
+            state="running",
+            initiated=self.start,
+        )
+
+
+class CampusOnlineTerminalBehaviourTestCase(CampusOnlineFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.room, self.terminal = self.create_room(1)
+        self.plugin = CampusOnlineTerminalBehaviour()
+
+    def clock(self, student):
+        terminals.invalidate()
+        terminal = terminals.get(self.terminal.pk)
+        entry = models.Entry.objects.create(terminal=terminal, student=student)
+        with CaptureQueriesContext(connection) as queries:
+            self.plugin.clock(entry=entry, payload={})
+        return len(queries)
+
+    def test_clock_queries_independent_of_roster(self):
+        small = self.create_holding(1, self.room, 5)
+        large = self.create_holding(2, self.room, 500)
+        first = small.course_group_term.coursegroup.students.first()
+        last = large.course_group_term.coursegroup.students.last()
+        self.assertEqual(self.clock(first), self.clock(last))
+        coe = models.CampusOnlineEntry.objects.get(incoming__student=last)
+        self.assertEqual(coe.holding, large)
+        self.assertTrue(coe.accredited)
+
+
+class CampusOnlineHoldingEndTestCase(CampusOnlineFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.room, self.terminal = self.create_room(1)
+        self.holding = self.create_holding(1, self.room, 2)
+        self.start = self.start.replace(microsecond=0)
+
+    def enter(self, student, **kwargs):
+        entry = models.Entry.objects.create(
+            terminal=self.terminal, student=student, created=self.start
+        )
+        return models.CampusOnlineEntry.objects.create(
+            incoming=entry,
+            room=self.room,
+            holding=self.holding,
+            assigned=self.start,
+            **kwargs,
+        )
+
+    def test_end_keeps_left_entries(self):
+        staying, leaving = self.holding.course_group_term.coursegroup.students.all()
+        left = self.start + timedelta(minutes=10)
+        finished = self.start + timedelta(minutes=30)
+        assigned = self.enter(staying, state="assigned")
+        gone = self.enter(leaving, state="left", ended=left)
+        with mock.patch.object(
+            models.CampusOnlineHoldingTasks.email_unaccredited, "delay"
+        ):
+            self.holding.end(finished=finished)
+        self.holding.save()
+        entries = models.CampusOnlineEntry.objects.in_bulk([assigned.pk, gone.pk])
+        self.assertEqual(entries[assigned.pk].state, "complete")
+        self.assertEqual(entries[assigned.pk].ended, finished)
+        self.assertEqual(entries[gone.pk].state, "complete")
+        self.assertEqual(entries[gone.pk].ended, left)
+        outbox = {
+            o.buchung_nr: dict(zip(models.STUD_LV_ANW, o.values))
+            for o in models.CampusOnlineOutbox.objects.filter(table="stud_lv_anw")
+        }
+        self.assertEqual(outbox[assigned.pk]["anm_begin"], self.start)
+        self.assertEqual(outbox[assigned.pk]["anm_ende"], finished)
+        self.assertEqual(outbox[gone.pk]["anm_ende"], left)
+        lv_anw = models.CampusOnlineOutbox.objects.get(table="lv_anw")
+        self.assertEqual(lv_anw.buchung_nr, self.holding.pk)
+        self.assertEqual(parse_datetime(lv_anw.data["lv_ende"]), finished)
+
+
+class ConditionalRequestTestCase(CampusOnlineFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.room, _ = self.create_room(1)
+        self.factory = APIRequestFactory()
+        self.user = get_user_model().objects.create(username="lecturer")
+        self.view = api.RoomStateViewSet.as_view({"get": "retrieve"})
+
+    def get(self, pk=None, **headers):
+        pk = pk or self.room.pk
+        request = self.factory.get(f"/{pk}/", **headers)
+        force_authenticate(request, user=self.user)
+        return self.view(request, pk=str(pk))
+
+    @override_settings(ATTENDANCE_CONDITIONAL_TIMEOUT=timedelta(days=36500))
+    def test_not_modified_without_queries(self):
+        etag = self.get()["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 0)
+        changes.bump(f"room:{self.room.pk}")
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    @override_settings(ATTENDANCE_CONDITIONAL_TIMEOUT=timedelta(days=36500))
+    def test_list_ignores_unlisted_rooms(self):
+        view = api.RoomStateViewSet.as_view({"get": "list"})
+
+        def get(**headers):
+            request = self.factory.get("/", **headers)
+            force_authenticate(request, user=self.user)
+            return view(request)
+
+        etag = get()["ETag"]
+        changes.bump(f"room:{self.room.pk + 1}")
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        changes.bump(f"room:{self.room.pk}")
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_wildcard_does_not_hide_missing_objects(self):
+        response = self.get(pk=self.room.pk + 1, HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 404)
+
+
+class ActiveCampusOnlineHoldingPermissionTestCase(
+    CampusOnlineFixturesMixin, TestCase
+):
+    def setUp(self):
+        super().setUp()
+        self.room, _ = self.create_room(1)
+        self.holding = self.create_holding(1, self.room, 1)
+        self.factory = APIRequestFactory()
+        self.user = get_user_model().objects.create(username="lecturer")
+        self.permission = ActiveCampusOnlineHoldingPermission()
+        lecturers.invalidate(self.lecturer.pk)
+
+    def check(self):
+        request = APIView().initialize_request(self.factory.post("/"))
+        request.user = self.user
+        return self.permission.has_permission(request, None)
+
+    def test_cached_per_user(self):
+        self.assertTrue(self.check())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.check())
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(
+            lecturers.holdings(self.lecturer.pk),
+            {self.holding.pk: self.holding.initiated},
+        )
+
+
+class DebounceTestCase(SimpleTestCase):
+    def setUp(self):
+        debounce.release(1, "0000ABCD")
+
+    def test_concurrent_swipe(self):
+        with self.settings(ATTENDANCE_CLOCK_DEBOUNCE_WAIT=timedelta(0)):
+            self.assertIsNone(debounce.claim(1, "0000ABCD"))
+            self.assertEqual(debounce.claim(1, "0000ABCD"), debounce.pending)
+            debounce.set(1, "0000ABCD", {"entry": 1})
+            self.assertEqual(debounce.claim(1, "0000ABCD"), {"entry": 1})
+            debounce.release(1, "0000ABCD")
+            self.assertIsNone(debounce.claim(1, "0000ABCD"))
+
+    def test_unavailable_cache(self):
+        # Memcached backends report failures as False/None.
+        cache = mock.Mock(**{"add.return_value": False, "get.return_value": None})
+        with self.settings(
+            ATTENDANCE_CLOCK_DEBOUNCE_WAIT=timedelta(milliseconds=100)
+        ), mock.patch("outpost.django.attendance.cache.caches") as caches:
+            caches.__getitem__.return_value = cache
+            start = perf_counter()
+            self.assertIsNone(debounce.claim(1, "0000ABCD"))
+            self.assertLess(perf_counter() - start, 1)
+            self.assertLess(cache.get.call_count, 10)
+
+
+class TimetableTestCase(SimpleTestCase):
+    Term = namedtuple("Term", ("start", "end"))
+    lifetime = timedelta(hours=1)
+    buffer = timedelta(minutes=30)
+
+    def setUp(self):
+        self.day = datetime(2026, 10, 17, tzinfo=timezone.utc)
+        self.first = self.term("08:00", "09:30")
+        self.second = self.term("09:45", "11:15")
+        self.last = self.term("13:00", "14:30")
+        self.timetable = Timetable()
+        for term in (self.last, self.first, self.second):
+            self.timetable.add(term)
+
+    def at(self, time):
+        hour, minute = map(int, time.split(":"))
+        return self.day.replace(hour=hour, minute=minute)
+
+    def term(self, start, end):
+        return self.Term(self.at(start), self.at(end))
+
+    def expired(self, created, now, timetable=None):
+        return (timetable or self.timetable).expired(
+            self.at(created), self.at(now), self.lifetime, self.buffer
+        )
+
+    def test_sorted(self):
+        self.assertEqual(self.timetable.terms, [self.first, self.second, self.last])
+        self.assertEqual(self.timetable.following(self.first), self.second)
+        self.assertIsNone(self.timetable.following(self.last))
+
+    def test_before_first_term(self):
+        self.assertEqual(
+            self.timetable.current(self.at("07:30"), self.lifetime), self.first
+        )
+        self.assertFalse(self.expired("07:30", "09:00"))
+        self.assertTrue(self.expired("07:30", "09:30"))
+        # No term starts within the lifetime of the entry.
+        self.assertIsNone(self.timetable.current(self.at("06:00"), self.lifetime))
+        self.assertFalse(self.expired("06:00", "06:30"))
+        self.assertTrue(self.expired("06:00", "07:00"))
+
+    def test_inside_term_with_following_within_buffer(self):
+        self.assertEqual(
+            self.timetable.current(self.at("09:20"), self.lifetime), self.first
+        )
+        self.assertFalse(self.expired("09:20", "12:00"))
+
+    def test_inside_term_with_following_outside_buffer(self):
+        self.assertFalse(self.expired("08:30", "09:00"))
+        self.assertTrue(self.expired("08:30", "10:00"))
+
+    def test_last_term_of_day(self):
+        self.assertEqual(
+            self.timetable.current(self.at("13:30"), self.lifetime), self.last
+        )
+        self.assertFalse(self.expired("13:30", "14:00"))
+        self.assertTrue(self.expired("13:30", "15:00"))
+        # After the last term only the lifetime counts.
+        self.assertIsNone(self.timetable.current(self.at("15:00"), self.lifetime))
+        self.assertFalse(self.expired("15:00", "15:30"))
+        self.assertTrue(self.expired("15:00", "16:00"))
+
+    def test_no_terms(self):
+        empty = Timetable()
+        self.assertIsNone(empty.current(self.at("10:00"), self.lifetime))
+        self.assertFalse(self.expired("10:00", "10:59", empty))
+        self.assertTrue(self.expired("10:00", "11:00", empty))
+
+
+class LocalBrokerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.broker = events.LocalBroker()
+
+    def test_publish_to_subscribed_topics(self):
+        with self.broker.subscribe("holding:1") as queue:
+            self.broker.publish(["holding:1", "room:1"], {"id": 1})
+            self.broker.publish(["holding:2", "room:1"], {"id": 2})
+            self.assertEqual(queue.get_nowait(), {"id": 1})
+            self.assertTrue(queue.empty())
+        self.assertEqual(self.broker.queues, dict())
+
+    def test_overflow(self):
+        with self.settings(ATTENDANCE_STREAM_QUEUE=1):
+            with self.broker.subscribe("room:1") as queue:
+                self.broker.publish(["room:1"], {"id": 1})
+                self.broker.publish(["room:1"], {"id": 2})
+                self.assertTrue(queue.overflow)
+                self.assertEqual(queue.get_nowait(), {"id": 1})
+
+
+class CacheBrokerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.broker = events.CacheBroker()
+
+    def test_publish_to_subscribed_topics(self):
+        with self.broker.subscribe("holding:1001") as queue:
+            self.broker.publish(["holding:1001", "room:1001"], {"id": 1})
+            self.broker.publish(["holding:1002", "room:1001"], {"id": 2})
+            self.assertEqual(queue.get(timeout=0), {"id": 1})
+            with self.assertRaises(Empty):
+                queue.get(timeout=0)
+
+    def test_publish_many(self):
+        with self.broker.subscribe("room:1002") as queue:
+            self.broker.publish_many(
+                [
+                    (["holding:1003", "room:1002"], {"id": 1}),
+                    (["room:1002"], {"id": 2}),
+                    (["holding:1003"], {"id": 3}),
+                ]
+            )
+            self.assertEqual(queue.get(timeout=0), {"id": 1})
+            self.assertEqual(queue.get(timeout=0), {"id": 2})
+            with self.assertRaises(Empty):
+                queue.get(timeout=0)
+
+    def test_overflow(self):
+        with self.settings(ATTENDANCE_STREAM_QUEUE=1):
+            with self.broker.subscribe("room:1003") as queue:
+                self.broker.publish(["room:1003"], {"id": 1})
+                self.broker.publish(["room:1003"], {"id": 2})
+                self.assertEqual(queue.get(timeout=0), {"id": 2})
+                self.assertTrue(queue.overflow)
+
+
+@skipUnless(os.environ.get("ATTENDANCE_BENCHMARK"), "ATTENDANCE_BENCHMARK not set")
+class LectureStartBenchmark(CampusOnlineFixturesMixin, TransactionTestCase):
+    """
+    Cost of swipes on the clock endpoints at the start of lectures.
+
+    Every student of every roster swipes once, half of them with a preflight
+    and a clock against `ClockView` and half with a single request against
+    `SwipeView`. Each room has `readers` terminals. `test_sequential` sends
+    all swipes from a single client to measure latency and queries of one
+    swipe depending on roster size. `test_burst` lets all terminals swipe at
+    once, each from its own thread and database connection, to measure
+    latency and throughput under concurrent load.
+
+    Only runs with `ATTENDANCE_BENCHMARK=1` in the environment, the report
+    is printed to stdout.
+    """
+
+    rosters = (50, 150, 300, 600)
+    readers = 4
+    behaviour = (
+        CampusOnlineTerminalBehaviour.qualified(),
+        "outpost.django.attendance.plugins.StatisticsTerminalBehaviour",
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.factory = APIRequestFactory()
+        self.user = get_user_model().objects.create(username="terminal")
+        self.modes = {
+            "clock": (
+                views.ClockView.as_view(),
+                lambda path: (
+                    self.factory.get(path),
+                    self.factory.post(path, {}, format="json"),
+                ),
+            ),
+            "swipe": (
+                views.SwipeView.as_view(),
+                lambda path: (self.factory.post(f"{path}swipe/", {}, format="json"),),
+            ),
+        }
+        self.swipes = list()
+        for pk, size in enumerate(self.rosters, start=1):
+            room, terminal = self.create_room(pk, behaviour=list(self.behaviour))
+            readers = [terminal] + [
+                models.Terminal.objects.create(
+                    hostname=f"terminal-{pk}-{i}",
+                    enabled=True,
+                    online=True,
+                    behaviour=list(self.behaviour),
+                )
+                for i in range(1, self.readers)
+            ]
+            statistics = models.Statistics.objects.create(name=f"statistics-{pk}")
+            for reader in readers[1:]:
+                reader.rooms.add(room)
+            statistics.terminals.add(*readers)
+            holding = self.create_holding(pk, room, size)
+            self.swipes.extend(
+                (("clock", "swipe")[i % 2], size, readers[i % self.readers], s)
+                for i, s in enumerate(
+                    holding.course_group_term.coursegroup.students.all()
+                )
+            )
+
+    def percentile(self, values, p):
+        values = sorted(values)
+        k = (len(values) - 1) * p / 100
+        f = int(k)
+        c = min(f + 1, len(values) - 1)
+        return values[f] + (values[c] - values[f]) * (k - f)
+
+    def swipe(self, mode, terminal, student):
+        view, requests = self.modes[mode]
+        kwargs = {"terminal_id": str(terminal.pk), "card_id": student.cardid}
+        with CaptureQueriesContext(connection) as queries:
+            start = perf_counter()
+            for request in requests(f"/{terminal.pk}/{student.cardid}/"):
+                force_authenticate(request, user=self.user)
+                response = view(request, **kwargs)
+                self.assertEqual(response.status_code, 200)
+            duration = perf_counter() - start
+        return duration, len(queries)
+
+    def reader(self, swipes):
+        try:
+            return [
+                ((mode, size), self.swipe(mode, terminal, student))
+                for mode, size, terminal, student in swipes
+            ]
+        finally:
+            connection.close()
+
+    def report(self, name, results, total):
+        count = sum(len(samples) for samples in results.values())
+        print(
+            f"\n{name}: {count} swipes in {total:.2f}s, "
+            f"{count / total:.1f} swipes/s"
+        )
+        for (mode, size), samples in sorted(results.items()):
+            latencies = [d * 1000 for d, _ in samples]
+            queries = [q for _, q in samples]
+            print(
+                f"{mode} roster {size:4d}: "
+                f"p50 {self.percentile(latencies, 50):7.2f}ms "
+                f"p95 {self.percentile(latencies, 95):7.2f}ms "
+                f"p99 {self.percentile(latencies, 99):7.2f}ms "
+                f"queries/swipe {sum(queries) / len(queries):5.1f} (max {max(queries)})"
+            )
+
+    def test_sequential(self):
+        results = dict()
+        start = perf_counter()
+        for mode, size, terminal, student in self.swipes:
+            results.setdefault((mode, size), list()).append(
+                self.swipe(mode, terminal, student)
+            )
+        self.report("sequential", results, perf_counter() - start)
+        for mode in self.modes:
+            self.assertEqual(
+                len(
+                    {
+                        max(q for _, q in samples)
+                        for (m, _), samples in results.items()
+                        if m == mode
+                    }
+                ),
+                1,
+            )
+
+    def test_burst(self):
+        readers = dict()
+        for swipe in self.swipes:
+            readers.setdefault(swipe[2].pk, list()).append(swipe)
+        results = dict()
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=len(readers)) as executor:
+            for samples in executor.map(self.reader, readers.values()):
+                for key, sample in samples:
+                    results.setdefault(key, list()).append(sample)
+        self.report("burst", results, perf_counter() - start)
+        self.assertEqual(
+            sum(len(samples) for samples in results.values()), len(self.swipes)
+        )
@@ -5,9 +5,19 @@ from . import views
 app_name = "attendance"
 
 urlpatterns = [
+    url(
+        r"^(?P<terminal_id>\d+)/batch/$",
+        views.BatchClockView.as_view(),
+        name="batch",
+    ),
     url(
         r"^(?P<terminal_id>\d+)/(?P<card_id>[\dA-F]{8})/$",
         views.ClockView.as_view(),
         name="input",
-    )
+    ),
+    url(
+        r"^(?P<terminal_id>\d+)/(?P<card_id>[\dA-F]{8})/swipe/$",
+        views.SwipeView.as_view(),
+        name="swipe",
+    ),
 ]
@@ -1,5 +1,7 @@
 import logging
 
+from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from outpost.django.campusonline import models as co
 from rest_framework import authentication, permissions, status
@@ -8,11 +10,26 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from outpost.django.campusonline.serializers import AuthenticatedStudentSerializer
-from . import models, serializers
+from . import metrics, models, serializers
+from .cache import debounce, preflights, students, terminals
+from .conf import settings
 
 logger = logging.getLogger(__name__)
 
 
+def get_terminal(terminal_id):
+    try:
+        with metrics.observe("terminal"):
+            terminal = terminals.get(terminal_id)
+    except models.Terminal.DoesNotExist:
+        logger.warn(f"Unknown terminal {terminal_id}")
+        raise NotFound(_("Unknown terminal identification"))
+    if not (terminal.online and terminal.enabled):
+        logger.warn(f"Terminal {terminal_id} is offline or disabled")
+        raise NotFound(_("Unknown terminal identification"))
+    return terminal
+
+
 class ClockView(APIView):
 
     permission_classes = [permissions.IsAuthenticated]
@@ -20,48 +37,209 @@ class ClockView(APIView):
     def initial(self, request, terminal_id, card_id, *args, **kwargs):
         super().initial(request, *args, **kwargs)
         logger.debug(f"Incoming request for terminal {terminal_id}")
+        self.debounced = None
+        self.claimed = None
+        if request.method == "POST":
+            self.debounced = debounce.claim(terminal_id, card_id)
+            if self.debounced is not None:
+                logger.debug(f"Debouncing {card_id} on terminal {terminal_id}")
+                metrics.clock_debounced.labels(int(terminal_id)).inc()
+                return
+            self.claimed = (terminal_id, card_id)
+        self.terminal = get_terminal(terminal_id)
         try:
-            self.terminal = models.Terminal.objects.get(
-                pk=terminal_id, online=True, enabled=True
-            )
-        except models.Terminal.DoesNotExist:
-            logger.warn(f"Unknown terminal {terminal_id}")
-            raise NotFound(_("Unknown terminal identification"))
-        try:
-            self.student = co.Student.objects.get(cardid=card_id)
+            with metrics.observe("student"):
+                self.student = students.get(card_id)
         except co.Student.DoesNotExist:
             logger.warn(f"No student found for cardid {card_id}")
             raise NotFound(_("Unknown student identification"))
 
+    def preflight(self):
+        data = self.terminal.plugins.hook.preflight(
+            terminal=self.terminal, student=self.student
+        )
+        return [entry for entry in data if entry]
+
+    def clock(self, payload):
+        entry = models.Entry.objects.create(
+            student=self.student, terminal=self.terminal
+        )
+        data = self.terminal.plugins.hook.clock(entry=entry, payload=payload)
+        preflights.invalidate(self.student.pk)
+        response = self.respond(entry=entry.pk, data=[d for d in data if d])
+        debounce.set(self.terminal.pk, self.student.cardid, response.data)
+        self.claimed = None
+        return response
+
+    def debounced_response(self):
+        if self.debounced == debounce.pending:
+            return Response(
+                {"detail": _("Previous swipe is still being processed")},
+                status.HTTP_409_CONFLICT,
+            )
+        return Response(self.debounced)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # Release a claim that did not end in a recorded clock, so the next
+        # swipe is processed instead of being debounced.
+        if getattr(self, "claimed", None):
+            debounce.release(*self.claimed)
+            self.claimed = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def respond(self, **kwargs):
+        with metrics.observe("serialize"):
+            return Response(
+                {
+                    "terminal": serializers.TerminalSerializer(self.terminal).data,
+                    "student": AuthenticatedStudentSerializer(self.student).data,
+                    "cardid": self.student.cardid,
+                    **kwargs,
+                }
+            )
+
     def get(self, request, **kwargs):
         logger.debug(f"Preflight request for {self.terminal}:{self.student}")
+        data = preflights.get(self.terminal.pk, self.student.pk)
+        if data is not None:
+            return Response(data)
         try:
-            data = self.terminal.plugins.hook.preflight(
-                terminal=self.terminal, student=self.student
-            )
+            response = self.respond(data=self.preflight())
         except Exception as e:
             return Response(str(e), status.HTTP_400_BAD_REQUEST)
-        return Response(
-            {
-                "terminal": serializers.TerminalSerializer(self.terminal).data,
-                "student": AuthenticatedStudentSerializer(self.student).data,
-                "cardid": self.student.cardid,
-                "data": [entry for entry in data if entry],
-            }
-        )
+        preflights.set(self.terminal.pk, self.student.pk, response.data)
+        return response
 
     def post(self, request, **kwargs):
+        if self.debounced is not None:
+            return self.debounced_response()
         logger.debug(f"Clock request for {self.terminal}:{self.student}")
-        entry = models.Entry.objects.create(
-            student=self.student, terminal=self.terminal
+        return self.clock(request.data)
+
+
+class SwipeView(ClockView):
+    """
+    Preflight and clock in a single request.
+
+    Runs all preflight hooks and, if none of them asks a question that is not
+    already answered in the request payload, clocks right away. Otherwise the
+    open questions are returned with `entry` set to `null` and the terminal
+    is expected to repeat the request with the answers in its payload.
+    """
+
+    http_method_names = ["post", "options"]
+
+    def post(self, request, **kwargs):
+        if self.debounced is not None:
+            return self.debounced_response()
+        logger.debug(f"Swipe request for {self.terminal}:{self.student}")
+        try:
+            data = self.preflight()
+        except Exception as e:
+            return Response(str(e), status.HTTP_400_BAD_REQUEST)
+        questions = [
+            d for d in data if "question" in d and d.get("id") not in request.data
+        ]
+        if questions:
+            logger.debug(f"Open questions for {self.terminal}:{self.student}")
+            return self.respond(entry=None, data=questions)
+        return self.clock(request.data)
+
+
+class BatchClockView(APIView):
+    """
+    Ingest swipes buffered by a terminal in one request.
+
+    Expects an ordered list of objects with `cardid`, `created` and an
+    optional `payload`. Items with an unknown card ID, a `created` timestamp
+    more than `ATTENDANCE_CLOCK_BATCH_SKEW` in the future or a failing
+    preflight hook are rejected. Preflight questions are not asked, their
+    answers are expected in the payload. All remaining entries are created
+    in one bulk insert, then the terminal behaviours are run for each of them
+    in order. The response holds one result per item, in the same order as
+    the request.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def initial(self, request, terminal_id, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        logger.debug(f"Incoming batch request for terminal {terminal_id}")
+        self.terminal = get_terminal(terminal_id)
+
+    def reject(self, item, error):
+        logger.warn(f"Rejecting {item['cardid']} from batch: {error}")
+        return {"cardid": item["cardid"], "error": error}
+
+    def post(self, request, **kwargs):
+        serializer = serializers.ClockBatchSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+        logger.debug(f"Batch of {len(items)} clocks for {self.terminal}")
+        known = {
+            s.cardid: s
+            for s in co.Student.objects.filter(
+                cardid__in={item["cardid"] for item in items}
+            )
+        }
+        latest = timezone.now() + settings.ATTENDANCE_CLOCK_BATCH_SKEW
+        preflight = dict()
+        results = list()
+        for item in items:
+            student = known.get(item["cardid"])
+            if not student:
+                results.append(self.reject(item, _("Unknown student identification")))
+                continue
+            if item["created"] > latest:
+                results.append(self.reject(item, _("Timestamp is in the future")))
+                continue
+            if student.pk not in preflight:
+                try:
+                    self.terminal.plugins.hook.preflight(
+                        terminal=self.terminal, student=student
+                    )
+                    preflight[student.pk] = None
+                except Exception as e:
+                    preflight[student.pk] = str(e)
+            if preflight[student.pk]:
+                results.append(self.reject(item, preflight[student.pk]))
+                continue
+            results.append(
+                models.Entry(
+                    student=student, terminal=self.terminal, created=item["created"]
+                )
+            )
+        entries = iter(
+            models.Entry.objects.bulk_create(
+                [r for r in results if isinstance(r, models.Entry)]
+            )
         )
-        data = self.terminal.plugins.hook.clock(entry=entry, payload=request.data)
+        for i, (item, result) in enumerate(zip(items, results)):
+            if not isinstance(result, models.Entry):
+                continue
+            entry = next(entries)
+            try:
+                with transaction.atomic():
+                    data = self.terminal.plugins.hook.clock(
+                        entry=entry, payload=item["payload"]
+                    )
+                preflights.invalidate(entry.student_id)
+            except Exception as e:
+                logger.warn(f"Failed to process {entry} from batch: {e}")
+                results[i] = {
+                    "cardid": item["cardid"],
+                    "entry": entry.pk,
+                    "error": str(e),
+                }
+                continue
+            results[i] = {
+                "cardid": item["cardid"],
+                "entry": entry.pk,
+                "data": [d for d in data if d],
+            }
         return Response(
             {
                 "terminal": serializers.TerminalSerializer(self.terminal).data,
-                "student": AuthenticatedStudentSerializer(self.student).data,
-                "cardid": self.student.cardid,
-                "entry": entry.pk,
-                "data": [entry for entry in data if entry],
+                "results": results,
             }
         )
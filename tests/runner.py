@@ -0,0 +1,44 @@
+from celery import current_app
+from django.apps import apps
+from django.db import connections
+from django.db.models.signals import pre_migrate
+from django.test.runner import DiscoverRunner
+
+
+class ManagedModelTestRunner(DiscoverRunner):
+    """
+    Create tables for the unmanaged CAMPUSonline models.
+
+    Their migrations are disabled in the test settings, so marking the models
+    as managed lets `migrate --run-syncdb` create plain tables for them.
+    Schemas referenced by their table names are created beforehand. Celery
+    tasks run eagerly instead of being sent to a broker.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        current_app.conf.task_always_eager = True
+        self.unmanaged = [
+            m
+            for m in apps.get_app_config("campusonline").get_models()
+            if not m._meta.managed
+        ]
+        for model in self.unmanaged:
+            model._meta.managed = True
+        pre_migrate.connect(self.create_schemas)
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        pre_migrate.disconnect(self.create_schemas)
+        for model in self.unmanaged:
+            model._meta.managed = False
+
+    def create_schemas(self, using, **kwargs):
+        schemas = {
+            m._meta.db_table.split('"."')[0]
+            for m in self.unmanaged
+            if '"."' in m._meta.db_table
+        }
+        with connections[using].cursor() as cursor:
+            for schema in schemas:
+                cursor.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
@@ -0,0 +1,50 @@
+"""
+Settings to run the test suite against a PostgreSQL database.
+
+    django-admin test outpost.django.attendance --settings=tests.settings --pythonpath=.
+
+Connection parameters are read from the usual `PG*` environment variables.
+"""
+import os
+
+SECRET_KEY = "tests"
+
+USE_TZ = True
+
+TIME_ZONE = "Europe/Vienna"
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "django.contrib.postgres",
+    "guardian",
+    "rest_framework",
+    "django_filters",
+    "outpost.django.base",
+    "outpost.django.campusonline",
+    "outpost.django.attendance",
+]
+
+AUTHENTICATION_BACKENDS = (
+    "django.contrib.auth.backends.ModelBackend",
+    "guardian.backends.ObjectPermissionBackend",
+)
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ.get("PGDATABASE", "outpost"),
+        "USER": os.environ.get("PGUSER", ""),
+        "PASSWORD": os.environ.get("PGPASSWORD", ""),
+        "HOST": os.environ.get("PGHOST", ""),
+        "PORT": os.environ.get("PGPORT", ""),
+    }
+}
+
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+# CAMPUSonline models are unmanaged views over a foreign data wrapper, the
+# runner creates plain tables for them instead of running their migrations.
+MIGRATION_MODULES = {"campusonline": None}
+
+TEST_RUNNER = "tests.runner.ManagedModelTestRunner"